@@ -0,0 +1,116 @@
+import os, sys, time, subprocess, pandas as pd
+from helper.config import PATHS, TOOLS, PARAMETERS
+from helper.logger import setup_logger
+from helper.path_define import base_dir, samid, rmdup_bam_path, bqsr_bam_path, ground_truth_vcf
+from helper.file_utils import save_results_to_csv
+from helper.concordance import single_counts
+from steps.alignment import ALIGNERS, REFINE_MODES, run_bwa_alignment, run_refine
+from helper.truth_store import load_truth_store, trio_samples
+
+logger = setup_logger(os.path.join(PATHS["logs"], "aligner_bench.log"))
+
+
+def flagstat(bam_file):
+    # samtools flagstat -O tsv lines: QC-passed, QC-failed, category
+    result = subprocess.run([TOOLS["samtools"], "flagstat", "-@", f"{PARAMETERS['threads']}", "-O", "tsv", bam_file],
+        capture_output=True, text=True, check=True)
+    counts = {}
+    for line in result.stdout.splitlines():
+        passed, _, category = line.split("\t")
+        counts.setdefault(category, passed)
+    return int(counts["primary"]), int(counts["primary mapped"])
+
+
+def bench_sample(fq, aligner):
+    outdir = os.path.join(base_dir(fq), "aligner_bench", aligner)
+    os.makedirs(outdir, exist_ok=True)
+
+    logger.info(f"Benchmarking {aligner} on {fq}")
+    start = time.perf_counter()
+    run_bwa_alignment(fq, outdir, aligner, use_cache=False)
+    runtime = time.perf_counter() - start
+
+    reads, mapped = flagstat(rmdup_bam_path(samid(fq), outdir))
+    return {
+        "Sample": fq,
+        "Aligner": aligner,
+        "Runtime (s)": round(runtime, 1),
+        "Reads": reads,
+        "Mapped": mapped,
+        "Mapping rate (%)": round(100 * mapped / reads, 3) if reads else 0,
+    }
+
+
+def concordance(bam_file, sample_name, outdir, ground_truths):
+    # Genotypes called straight from the BAM at the truth sites, compared like stats_single does
+    totals = {"GT_true": 0, "GT_false": 0, "ALT_true": 0, "ALT_false": 0}
+    for chromosome, ground_truth in ground_truths.items():
+        calls = os.path.join(outdir, f"{sample_name}.{chromosome}.calls.bcf")
+        mpileup = subprocess.Popen([TOOLS["bcftools"], "mpileup", "-f", PATHS["ref"], "-r", chromosome,
+            "-T", ground_truth_vcf(chromosome), "-Ou", bam_file], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        subprocess.run([TOOLS["bcftools"], "call", "-m", "-Ob", "-o", calls], stdin=mpileup.stdout, check=True)
+        mpileup.stdout.close()
+        if mpileup.wait() != 0:
+            raise RuntimeError(f"mpileup failed for {bam_file} on {chromosome}")
+
+        for column, counts in single_counts(calls, ground_truth, sample_name).items():
+            totals[column] += int(counts.sum())
+    return totals
+
+
+def bench_refine(fq, ground_truths):
+    # Every refine mode starts from the same rmdup BAM, linked into its own directory
+    bam_file = rmdup_bam_path(samid(fq), os.path.join(base_dir(fq), "aligner_bench", "rmdup"))
+    os.makedirs(os.path.dirname(bam_file), exist_ok=True)
+    run_bwa_alignment(fq, os.path.dirname(bam_file))
+
+    rows = []
+    for mode in REFINE_MODES:
+        outdir = os.path.join(base_dir(fq), "aligner_bench", f"refine_{mode}")
+        os.makedirs(outdir, exist_ok=True)
+        for src_file in (bam_file, f"{bam_file}.bai"):
+            dst_file = os.path.join(outdir, os.path.basename(src_file))
+            if not os.path.exists(dst_file):
+                os.link(src_file, dst_file)
+
+        logger.info(f"Benchmarking refine mode {mode} on {fq}")
+        start = time.perf_counter()
+        run_refine(samid(fq), outdir, mode, use_cache=False)
+        runtime = time.perf_counter() - start
+
+        totals = concordance(bqsr_bam_path(samid(fq), outdir), samid(fq), outdir, ground_truths)
+        called = totals["GT_true"] + totals["GT_false"]
+        alt = totals["ALT_true"] + totals["ALT_false"]
+        rows.append({
+            "Sample": fq,
+            "Refine": mode,
+            "Runtime (s)": round(runtime, 1),
+            **totals,
+            "GT concordance (%)": round(100 * totals["GT_true"] / called, 3) if called else 0,
+            "ALT precision (%)": round(100 * totals["ALT_true"] / alt, 3) if alt else 0,
+        })
+    return rows
+
+
+def main():
+    # Runtime includes the streaming sort/markdup stages, so it matches one alignment task of the pipeline.
+    # Timed steps bypass the step cache, so every run is measured from scratch
+    if len(sys.argv) < 3 or sys.argv[1] not in ("aligner", "refine"):
+        logger.error("Usage: aligner_bench.py aligner|refine <fastq>...")
+        sys.exit(1)
+
+    mode, fqs = sys.argv[1], sys.argv[2:]
+    if mode == "aligner":
+        rows = [bench_sample(fq, aligner) for fq in fqs for aligner in ALIGNERS]
+        df = pd.DataFrame(rows).set_index(["Sample", "Aligner"])
+    else:
+        ground_truths = {chromosome: load_truth_store(ground_truth_vcf(chromosome), trio_samples()) for chromosome in PARAMETERS["chrs"]}
+        rows = [row for fq in fqs for row in bench_refine(fq, ground_truths)]
+        df = pd.DataFrame(rows).set_index(["Sample", "Refine"])
+
+    print(df)
+    save_results_to_csv(os.path.join(PATHS["result_directory"], f"{mode}_bench.csv"), df)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-from helper.generate import generate_single_sample, generate_nipt_sample
-from steps.alignment import run_alignment_pipeline
-from steps.basevar import run_basevar
-from steps.glimpse import run_glimpse
+from helper.generate import generate_single_sweep, generate_nipt_samples
+from steps.alignment import alignment_tasks
+from steps.basevar import basevar_tasks
+from steps.glimpse import glimpse_tasks
+from helper.scheduler import run_tasks, scope_tasks
 
 from steps.reference_panel_prepare import run_prepare_reference_panel
 from helper.config import PARAMETERS, TRIO_DATA, PATHS
@@ -10,6 +11,7 @@ from helper.logger import setup_logger
 from helper.file_utils import extract_lane1_fq
 from helper.converter import convert_cram_to_fastq
 from helper.path_define import fastq_path, fastq_path_lane1, fastq_path_lane2, cram_path
+from helper.path_define import tmp_outdir, batch1_final_outdir, bamlist_dir
 import os, sys
 from concurrent.futures import ThreadPoolExecutor
 
@@ -17,11 +19,19 @@ from concurrent.futures import ThreadPoolExecutor
 logger = setup_logger(os.path.join(PATHS["logs"], "main.log"))
 
 
+def sample_tasks(fastq_dir):
+    # The whole per-sample graph, scoped by its FASTQ path so every sample of a sweep can share one run
+    os.makedirs(tmp_outdir(fastq_dir), exist_ok=True)
+    os.makedirs(batch1_final_outdir(fastq_dir), exist_ok=True)
+
+    tasks = alignment_tasks(fastq_dir, tmp_outdir(fastq_dir), batch1_final_outdir(fastq_dir), bamlist_dir(fastq_dir))
+    deps = [tasks[-1].name]
+    return scope_tasks(tasks + basevar_tasks(fastq_dir, deps) + glimpse_tasks(fastq_dir, deps), fastq_dir)
+
+
 def pipeline_for_sample(fastq_dir):
     logger.info(f"Run all pipeline for sample in {fastq_dir}")
-    run_alignment_pipeline(fastq_dir)
-    run_basevar(fastq_dir)
-    run_glimpse(fastq_dir)
+    run_tasks(sample_tasks(fastq_dir))
 
 def prepare_data(name):
     print(f"Preparing data for {name}")
@@ -44,14 +54,21 @@ def process_trio(trio_name, trio_info):
      #   executor.map(prepare_data, [child_name, mother_name])
 
 
-    for index in range(PARAMETERS["startSampleIndex"], PARAMETERS["endSampleIndex"] + 1):
+    indices = range(PARAMETERS["startSampleIndex"], PARAMETERS["endSampleIndex"] + 1)
+    single_sweep = generate_single_sweep(mother_name, PARAMETERS["coverage"], indices)
+
+    # One task graph for the whole index x coverage sweep, so samples overlap under the shared budget
+    tasks = []
+    for index in indices:
         logger.info(f"######## PROCESSING index {index} ########")
 
-        for coverage in PARAMETERS["coverage"]:
-            pipeline_for_sample(generate_single_sample(mother_name, coverage, index))
+        for coverage, single_sample in zip(PARAMETERS["coverage"], single_sweep[index]):
+            tasks += sample_tasks(single_sample)
+
+            #for nipt_sample in generate_nipt_samples(child_name, mother_name, father_name, coverage, PARAMETERS["ff"], index):
+            #    tasks += sample_tasks(nipt_sample)
 
-            #for ff in PARAMETERS["ff"]:
-            #    pipeline_for_sample(generate_nipt_sample(child_name, mother_name, father_name, coverage, ff, index))
+    run_tasks(tasks)
 
 
 def main():
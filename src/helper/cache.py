@@ -0,0 +1,177 @@
+import os, sys, json, shutil, hashlib, threading
+from helper.config import PATHS, TOOLS, PARAMETERS
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "cache.log"))
+
+CACHE_DIR = PATHS.get("cache_directory", os.path.join(PATHS["result_directory"], "step_cache"))
+BLOCK_SIZE = 1 << 16
+SAMPLED_BLOCKS = 16
+# Size cap of the cache in GB; least recently used entries are evicted past it (None = unbounded)
+MAX_SIZE = PARAMETERS.get("cache", {}).get("max_size")
+
+_signatures = {}
+_lock = threading.Lock()
+
+
+def file_signature(path):
+    # Size plus a digest of evenly spaced blocks; memoized on (path, size, mtime)
+    # so unchanged multi-GB inputs are only sampled once per process
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if memo_key in _signatures:
+            return _signatures[memo_key]
+
+    digest = hashlib.blake2b(str(stat.st_size).encode(), digest_size=16)
+    with open(path, "rb") as f:
+        if stat.st_size <= BLOCK_SIZE * SAMPLED_BLOCKS:
+            digest.update(f.read())
+        else:
+            stride = (stat.st_size - BLOCK_SIZE) // (SAMPLED_BLOCKS - 1)
+            for i in range(SAMPLED_BLOCKS):
+                f.seek(i * stride)
+                digest.update(f.read(BLOCK_SIZE))
+
+    signature = digest.hexdigest()
+    with _lock:
+        _signatures[memo_key] = signature
+    return signature
+
+
+def list_entries(list_file):
+    with open(list_file) as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+def step_key(name, inputs=(), tools=(), params=None):
+    # Content-addressed key: input contents, tool binaries and parameter values, never paths
+    description = {
+        "step": name,
+        "inputs": [file_signature(path) for path in inputs],
+        "tools": [file_signature(TOOLS[tool]) if os.path.exists(TOOLS[tool]) else TOOLS[tool] for tool in tools],
+        "params": params or {},
+    }
+    encoded = json.dumps(description, sort_keys=True, default=str).encode()
+    return f"{name}-{hashlib.blake2b(encoded, digest_size=20).hexdigest()}"
+
+
+def _entry_dir(key):
+    return os.path.join(CACHE_DIR, key)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _remove(path):
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def discard_outputs(outputs):
+    # Unlink outputs before recomputing them in place; they may be hard links into a cache entry
+    for path in outputs:
+        _remove(path)
+
+
+def restore_outputs(key, outputs):
+    """
+    Link the cached outputs of `key` into place and return True on a hit.
+    On a miss the stale outputs are removed, so a rerun never writes through
+    a hard link that belongs to another cache entry.
+    """
+    entry = _entry_dir(key)
+    manifest = os.path.join(entry, "manifest.json")
+
+    if not os.path.exists(manifest):
+        discard_outputs(outputs)
+        return False
+
+    with open(manifest) as f:
+        names = json.load(f)["outputs"]
+    if len(names) != len(outputs):
+        raise RuntimeError(f"Cache entry {key} holds {len(names)} outputs, expected {len(outputs)}")
+
+    for name, path in zip(names, outputs):
+        cached = os.path.join(entry, name)
+        if os.path.exists(path) and os.path.samefile(path, cached):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _remove(path)
+        _link_or_copy(cached, path)
+
+    # Mark the entry as recently used for eviction
+    os.utime(manifest)
+    logger.info(f"Restored {len(outputs)} outputs from cache entry {key}")
+    return True
+
+
+def store_outputs(key, outputs):
+    entry = _entry_dir(key)
+    if os.path.exists(entry):
+        return
+
+    tmp_entry = f"{entry}.tmp{os.getpid()}.{threading.get_ident()}"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+
+    names = []
+    for i, path in enumerate(outputs):
+        name = f"{i}.{os.path.basename(path)}"
+        _link_or_copy(path, os.path.join(tmp_entry, name))
+        names.append(name)
+
+    with open(os.path.join(tmp_entry, "manifest.json"), "w") as f:
+        json.dump({"outputs": names, "paths": outputs}, f, indent=4)
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another worker stored the same key first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    logger.info(f"Stored {len(outputs)} outputs under cache entry {key}")
+
+    if MAX_SIZE is not None:
+        purge_cache(MAX_SIZE)
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def purge_cache(max_size=0):
+    """
+    Evict least recently used entries until the cache holds at most `max_size` GB; 0 empties it.
+    Outputs already linked into a result directory stay there, only the cache's own link goes.
+    """
+    with _lock:
+        if not os.path.isdir(CACHE_DIR):
+            return 0
+
+        entries = []
+        for key in os.listdir(CACHE_DIR):
+            manifest = os.path.join(_entry_dir(key), "manifest.json")
+            if os.path.exists(manifest):
+                entries.append((os.path.getmtime(manifest), _entry_size(_entry_dir(key)), key))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, key in sorted(entries):
+            if total <= max_size * 1024 ** 3:
+                break
+            shutil.rmtree(_entry_dir(key), ignore_errors=True)
+            total -= size
+            evicted += 1
+
+    if evicted:
+        logger.info(f"Evicted {evicted} cache entries, {total / 1024 ** 3:.1f}G left")
+    return evicted
+
+
+if __name__ == "__main__":
+    # python -m helper.cache [max_size_gb]: purge the cache down to max_size_gb (default: empty it)
+    purge_cache(float(sys.argv[1]) if len(sys.argv) > 1 else 0)
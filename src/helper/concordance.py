@@ -0,0 +1,180 @@
+import os, itertools, functools
+import numpy as np
+from cyvcf2 import VCF
+from helper.config import PATHS
+from helper.logger import setup_logger
+from helper.truth_store import allele_hash, genotype_code, HOM_REF, NO_CALL
+
+logger = setup_logger(os.path.join(PATHS["logs"], "concordance.log"))
+
+MAF_BINS = 51
+BLOCK_SIZE = 100000
+WINDOW = 5000000
+
+
+# cyvcf2 gt_types (HOM_REF, HET, UNKNOWN, HOM_ALT) of a biallelic site in the allele-set encoding
+GT_TYPE_CODES = np.array([HOM_REF, 0b11, NO_CALL, 0b10], dtype=np.int8)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def cached_allele_hash(ref, alt):
+    # SNPs repeat a handful of REF>ALT pairs, so most records never reach blake2b
+    return allele_hash(ref, alt)
+
+
+def records_block(records):
+    """
+    (positions, (REF, ALT) pairs, genotype codes) of the first sample of `records`. Codes come
+    from gt_types for the whole block; only multiallelic records, where the ALT index matters,
+    are decoded allele by allele.
+    """
+    positions, alleles, gt_types, multiallelic = [], [], [], []
+    for i, record in enumerate(records):
+        positions.append(record.POS)
+        alleles.append((record.REF, record.ALT[0] if record.ALT else ""))
+        gt_types.append(record.gt_types[0])
+        if len(record.ALT) > 1:
+            multiallelic.append((i, genotype_code(record.genotypes[0])))
+
+    codes = GT_TYPE_CODES[np.array(gt_types, dtype=np.int64)]
+    for i, code in multiallelic:
+        codes[i] = code if code is not None else NO_CALL
+    return np.array(positions, dtype=np.int64), alleles, codes
+
+
+def match_rows(ground_truth, positions, alleles, lo=0, hi=None):
+    # Truth rows of a block's records, -1 where absent; only records at a truth position get hashed
+    pos = ground_truth.pos[lo:hi]
+    candidates = np.minimum(np.searchsorted(pos, positions), max(len(pos) - 1, 0))
+    at_truth = np.flatnonzero(pos[candidates] == positions) if len(pos) else np.array([], dtype=np.int64)
+
+    rows = np.full(len(positions), -1, dtype=np.int64)
+    if len(at_truth):
+        hashes = np.array([cached_allele_hash(*alleles[i]) for i in at_truth], dtype=np.int64)
+        rows[at_truth] = ground_truth.find_rows(positions[at_truth], hashes, lo, hi)
+    return rows
+
+
+def call_blocks(vcf_path, block_size=BLOCK_SIZE):
+    """
+    Yield (positions, (REF, ALT) pairs, genotype codes) of the first sample of `vcf_path`,
+    block_size records at a time, with codes in the truth store's allele-set encoding.
+    """
+    records = iter(VCF(vcf_path, lazy=True))
+    while True:
+        block = records_block(itertools.islice(records, block_size))
+        if not len(block[0]):
+            return
+        yield block
+
+
+def joined_blocks(vcf_path, ground_truth, sample_names):
+    # Calls joined to the truth: (MAF bin, call codes, {sample: truth codes}) of every matched record
+    columns = [ground_truth.column(name) for name in sample_names]
+    if min(columns) < 0:
+        return
+
+    for positions, alleles, codes in call_blocks(vcf_path):
+        rows = match_rows(ground_truth, positions, alleles)
+        matched = rows >= 0
+        if not matched.any():
+            continue
+        rows = rows[matched]
+        truths = {name: np.asarray(ground_truth.gt[rows, column]) for name, column in zip(sample_names, columns)}
+        yield np.asarray(ground_truth.maf[rows]).astype(np.int64), codes[matched], truths
+
+
+def count(maf, mask):
+    return np.bincount(maf[mask], minlength=MAF_BINS)
+
+
+SINGLE_COLUMNS = ("GT_true", "GT_false", "ALT_true", "ALT_false")
+
+
+def score_single(totals, maf, gt, truth):
+    alt = gt != HOM_REF
+    totals["GT_true"] += count(maf, gt == truth)
+    totals["GT_false"] += count(maf, gt != truth)
+    totals["ALT_true"] += count(maf, alt & (truth != HOM_REF))
+    totals["ALT_false"] += count(maf, alt & (truth == HOM_REF))
+
+
+def single_counts(vcf_path, ground_truth, sample_name):
+    """
+    Per-MAF-bin GT/ALT true/false counts of one call set, as compare_with_ground_truth scores them.
+    """
+    totals = {column: np.zeros(MAF_BINS, dtype=np.int64) for column in SINGLE_COLUMNS}
+    for maf, gt, truths in joined_blocks(vcf_path, ground_truth, [sample_name]):
+        score_single(totals, maf, gt, truths[sample_name])
+    return totals
+
+
+def windowed_joins(callers, ground_truth, sample_names, chromosome, window=WINDOW):
+    """
+    Yield (prefix, MAF bin, call codes, {sample: truth codes}) for every {prefix: indexed VCF}
+    in `callers`, walking `chromosome` window by window in coordinate order: each truth window
+    is located once and every caller's records for it are fetched through the tabix index.
+    """
+    columns = [ground_truth.column(name) for name in sample_names]
+    if min(columns) < 0 or not len(ground_truth):
+        return
+
+    readers = {prefix: VCF(vcf_path, lazy=True) for prefix, vcf_path in callers.items()}
+    last = int(ground_truth.pos[-1])
+    for start in range(1, last + 1, window):
+        end = min(start + window - 1, last)
+        lo, hi = ground_truth.window(start, end)
+        if lo == hi:
+            continue
+        truths = {name: np.asarray(ground_truth.gt[lo:hi, column]) for name, column in zip(sample_names, columns)}
+        maf = np.asarray(ground_truth.maf[lo:hi]).astype(np.int64)
+
+        for prefix, reader in readers.items():
+            # Records overlapping the window from the left were already counted in the previous one
+            records = (record for record in reader(f"{chromosome}:{start}-{end}") if record.POS >= start)
+            positions, alleles, gt = records_block(records)
+            rows = match_rows(ground_truth, positions, alleles, lo, hi)
+            matched = rows >= 0
+            rows = rows[matched] - lo
+            yield prefix, maf[rows], gt[matched], {name: truth[rows] for name, truth in truths.items()}
+
+
+def callers_counts(callers, ground_truth, sample_name, chromosome, window=WINDOW):
+    """
+    single_counts() of every {prefix: indexed VCF} in `callers` from one walk over the truth,
+    so an extra caller costs one more indexed read per window, not another full scan.
+    """
+    totals = {prefix: {column: np.zeros(MAF_BINS, dtype=np.int64) for column in SINGLE_COLUMNS} for prefix in callers}
+    for prefix, maf, gt, truths in windowed_joins(callers, ground_truth, [sample_name], chromosome, window):
+        score_single(totals[prefix], maf, gt, truths[sample_name])
+    return totals
+
+
+def nipt_counts(vcf_path, ground_truth, child, mom, chromosome):
+    """
+    Per-MAF-bin counts of one NIPT call set scored against both the child and the mother.
+    """
+    columns = [
+        "gt_both_correct", "gt_mom_correct", "gt_child_correct",
+        "gt_mom_correct_child_wrong", "gt_child_correct_mom_wrong", "gt_both_wrong",
+        "alt_both_correct", "alt_mom_correct", "alt_child_correct",
+        "alt_mom_correct_child_wrong", "alt_child_correct_mom_wrong", "alt_both_wrong",
+    ]
+    totals = {column: np.zeros(MAF_BINS, dtype=np.int64) for column in columns}
+
+    for _, maf, gt, truths in windowed_joins({"glimpse": vcf_path}, ground_truth, [child, mom], chromosome):
+        alt = gt != HOM_REF
+        outcomes = {
+            "gt": (gt == truths[child], gt == truths[mom]),
+            "alt": (alt & (truths[child] != HOM_REF), alt & (truths[mom] != HOM_REF)),
+        }
+        for prefix, (child_ok, mom_ok) in outcomes.items():
+            both_wrong = ~child_ok & ~mom_ok
+            totals[f"{prefix}_both_correct"] += count(maf, child_ok & mom_ok)
+            totals[f"{prefix}_mom_correct_child_wrong"] += count(maf, mom_ok & ~child_ok)
+            totals[f"{prefix}_child_correct_mom_wrong"] += count(maf, child_ok & ~mom_ok)
+            totals[f"{prefix}_both_wrong"] += count(maf, both_wrong & alt if prefix == "alt" else both_wrong)
+            totals[f"{prefix}_mom_correct"] += count(maf, mom_ok)
+            totals[f"{prefix}_child_correct"] += count(maf, child_ok)
+
+    return totals
@@ -0,0 +1,130 @@
+import os
+import multiprocessing
+import numpy as np
+import pysam
+from concurrent.futures import ProcessPoolExecutor
+from helper.config import PATHS, PARAMETERS
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "coverage.log"))
+
+BIN_SIZE = PARAMETERS["alignment"].get("coverage_bin_size", 5000000)
+MAX_DEPTH = PARAMETERS["alignment"].get("max_depth", 100)
+WINDOW = 1000000
+WORKERS = PARAMETERS["threads"]
+# GB per worker: a few WINDOW-long int64 arrays plus pysam buffers
+WORKER_MEMORY = 0.25
+
+
+def window_depth(bam_file, contig, start, end):
+    """
+    Per-base depth of [start, end) on `contig`. Aligned blocks are used, like `bedtools genomecov
+    -split`, so deletions and splices count as 0; blocks are clipped to the window, so memory is
+    bounded by the window length however long or deep the contig is.
+    """
+    block_starts, block_ends = [], []
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        for read in bam.fetch(contig, start, end):
+            if read.is_unmapped:
+                continue
+            for block_start, block_end in read.get_blocks():
+                if block_end > start and block_start < end:
+                    block_starts.append(max(block_start, start) - start)
+                    block_ends.append(min(block_end, end) - start)
+
+    # +1 at every block start and -1 at every block end, summed into depth
+    size = end - start + 1
+    deltas = np.bincount(np.array(block_starts, dtype=np.int64), minlength=size) \
+        - np.bincount(np.array(block_ends, dtype=np.int64), minlength=size)
+    return np.cumsum(deltas[:-1])
+
+
+def summarise_window(bam_file, contig, start, end, bin_size=BIN_SIZE, max_depth=MAX_DEPTH):
+    # Partial bin sums, covered bases and depth histogram of one window; only these cross processes
+    depth = window_depth(bam_file, contig, start, end)
+    first_bin = start // bin_size
+    return {
+        "first_bin": first_bin,
+        "bin_sums": np.bincount(np.arange(start, end) // bin_size - first_bin, weights=depth),
+        "covered": int(np.count_nonzero(depth)),
+        "histogram": np.bincount(np.minimum(depth, max_depth), minlength=max_depth + 1),
+    }
+
+
+def new_contig_summary(length, bin_size, max_depth):
+    bin_starts = np.arange(0, length, bin_size, dtype=np.int64)
+    return {
+        "bin_start": bin_starts,
+        "bin_lengths": np.minimum(bin_starts + bin_size, length) - bin_starts,
+        "bin_sums": np.zeros(len(bin_starts)),
+        "covered": 0,
+        "histogram": np.zeros(max_depth + 1, dtype=np.int64),
+    }
+
+
+def add_window(summary, window):
+    first_bin = window["first_bin"]
+    summary["bin_sums"][first_bin:first_bin + len(window["bin_sums"])] += window["bin_sums"]
+    summary["covered"] += window["covered"]
+    summary["histogram"] += window["histogram"]
+
+
+def summarise_coverage(bam_file, output_npz, bin_size=BIN_SIZE, max_depth=MAX_DEPTH, workers=WORKERS):
+    """
+    Per-contig mean depth and covered fraction, per-bin mean depth and depth histograms
+    (depths above `max_depth` are counted in the last bucket) of `bam_file`, computed window
+    by window from the BAM index on `workers` processes and saved as compressed arrays in
+    `output_npz`. Each worker holds one WINDOW of depth at a time.
+    """
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        contigs = list(bam.references)
+        lengths = np.array(bam.lengths, dtype=np.int64)
+
+    windows = [(contig, start, min(start + WINDOW, int(length)))
+        for contig, length in zip(contigs, lengths) for start in range(0, int(length), WINDOW)]
+    summaries = {contig: new_contig_summary(int(length), bin_size, max_depth) for contig, length in zip(contigs, lengths)}
+
+    logger.info(f"Summarising coverage of {bam_file} over {len(contigs)} contigs, {len(windows)} windows, {bin_size}bp bins")
+    # spawn, not fork: this runs inside the scheduler's worker threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = executor.map(summarise_window,
+            [bam_file] * len(windows), *zip(*windows), [bin_size] * len(windows), [max_depth] * len(windows),
+            chunksize=16) if windows else []
+        for (contig, _, _), window in zip(windows, results):
+            add_window(summaries[contig], window)
+    summaries = [summaries[contig] for contig in contigs]
+
+    tmp_npz = output_npz.replace(".npz", ".tmp.npz")
+    np.savez_compressed(tmp_npz,
+        contigs=np.array(contigs),
+        lengths=lengths,
+        mean_depth=np.array([summary["bin_sums"].sum() for summary in summaries]) / np.maximum(lengths, 1),
+        covered_fraction=np.array([summary["covered"] for summary in summaries]) / np.maximum(lengths, 1),
+        bin_size=np.int64(bin_size),
+        bin_contig=np.concatenate([np.full(len(summary["bin_start"]), i) for i, summary in enumerate(summaries)]),
+        bin_start=np.concatenate([summary["bin_start"] for summary in summaries]),
+        bin_mean=np.concatenate([summary["bin_sums"] / summary["bin_lengths"] for summary in summaries]),
+        contig_histogram=np.stack([summary["histogram"] for summary in summaries]),
+        histogram=np.sum([summary["histogram"] for summary in summaries], axis=0),
+    )
+    os.replace(tmp_npz, output_npz)
+    logger.info(f"Coverage summary saved to {output_npz}")
+    return output_npz
+
+
+def load_coverage(summary_npz):
+    with np.load(summary_npz) as summary:
+        return {name: summary[name] for name in summary.files}
+
+
+def mean_depth_per_contig(summary):
+    return dict(zip(summary["contigs"].tolist(), summary["mean_depth"].tolist()))
+
+
+def mean_depth_per_bin(summary, contig):
+    # Bins are per contig and split at exact bin boundaries. statistics/bedtools_stats_1.py instead
+    # pools every chromosome's intervals into one genome-wide bin keyed by interval midpoint // bin
+    # size, so its values are not a drop-in match for these.
+    index = summary["contigs"].tolist().index(contig)
+    selected = summary["bin_contig"] == index
+    return dict(zip((summary["bin_start"][selected] // summary["bin_size"]).tolist(), summary["bin_mean"][selected].tolist()))
@@ -0,0 +1,218 @@
+import os, json, random, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from helper.config import PATHS, TOOLS, PARAMETERS
+from helper.path_define import fastq_manifest
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "fastq_stream.log"))
+
+WRITE_BATCH = 10000
+
+
+def new_seed():
+    return random.randint(1, 10**9 + 7)
+
+
+def read_manifest(output_file):
+    manifest = fastq_manifest(output_file)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        return json.load(f)
+
+
+def write_manifest(output_file, info):
+    with open(fastq_manifest(output_file), "w") as f:
+        json.dump(info, f, indent=4)
+
+
+def read_fastq(input_file):
+    if not os.path.exists(input_file):
+        logger.error(f"Sample {input_file} cannot be read.")
+        raise RuntimeError(f"Failed to read sample: {input_file}")
+
+    process = subprocess.Popen([TOOLS["pigz"], "-dc", input_file], stdout=subprocess.PIPE, bufsize=1 << 20)
+    lines = process.stdout
+    while True:
+        header = lines.readline()
+        if not header:
+            break
+        yield header + lines.readline() + lines.readline() + lines.readline()
+
+    lines.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"Failed to decompress {input_file}")
+
+
+def open_writer(output_file, max_length, threads):
+    # seqtk trimfq keeps today's trimming semantics; pigz compresses with several threads.
+    # Records go to a temporary file so a partial output is never mistaken for a finished one
+    tmp_file = output_file.replace(".fastq.gz", "_tmp.fastq.gz")
+    out = open(tmp_file, "wb")
+    trim = subprocess.Popen([TOOLS["seqtk"], "trimfq", "-L", f"{max_length}", "-"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    pigz = subprocess.Popen([TOOLS["pigz"], "-p", f"{threads}", "-c"], stdin=trim.stdout, stdout=out)
+    trim.stdout.close()
+    return {"output": output_file, "tmp": tmp_file, "file": out, "trim": trim, "pigz": pigz,
+        "buffer": [], "reads": 0, "pool": ThreadPoolExecutor(max_workers=1), "pending": None}
+
+
+def flush_writer(writer):
+    # Hand the batch to the writer's own thread so the scan never blocks on one output's pipe;
+    # waiting for the previous batch first keeps at most two batches in flight per output
+    chunk = b"".join(writer["buffer"])
+    writer["buffer"] = []
+    if writer["pending"]:
+        writer["pending"].result()
+    writer["pending"] = writer["pool"].submit(writer["trim"].stdin.write, chunk)
+
+
+def write_record(writer, record):
+    writer["buffer"].append(record)
+    writer["reads"] += 1
+    if len(writer["buffer"]) >= WRITE_BATCH:
+        flush_writer(writer)
+
+
+def close_writer(writer):
+    flush_writer(writer)
+    writer["pending"].result()
+    writer["pool"].shutdown()
+    writer["trim"].stdin.close()
+    trim_code = writer["trim"].wait()
+    pigz_code = writer["pigz"].wait()
+    writer["file"].close()
+
+    if trim_code != 0 or pigz_code != 0:
+        os.remove(writer["tmp"])
+        raise RuntimeError(f"Failed to write {writer['output']}")
+    os.replace(writer["tmp"], writer["output"])
+
+
+def abort_writer(writer):
+    writer["pool"].shutdown(wait=False, cancel_futures=True)
+    for process in (writer["trim"], writer["pigz"]):
+        process.kill()
+        process.wait()
+    writer["file"].close()
+    if os.path.exists(writer["tmp"]):
+        os.remove(writer["tmp"])
+
+
+def subsample_fastq(input_file, input_reads, replicates, max_length=PARAMETERS["read_length"]):
+    """
+    Write every replicate in `replicates`, a list of (seed, [(output_file, num_reads), ...]),
+    from a single scan of `input_file`. Each replicate draws one uniform number per read from
+    its own generator and keeps the read in every output whose fraction num_reads / input_reads
+    exceeds it, so within a replicate smaller outputs are subsets of larger ones, replicates are
+    independent, and each one is reproducible from its recorded seed alone.
+    """
+    outputs = [output for _, replicate_outputs in replicates for output in replicate_outputs]
+    logger.info(f"Subsampling {input_file} into {len(replicates)} replicates, {len(outputs)} outputs...")
+
+    threads = max(1, PARAMETERS["threads"] // len(outputs))
+    streams = []
+    for seed, replicate_outputs in replicates:
+        targets = sorted(
+            ((num_reads / input_reads, output_file, num_reads) for output_file, num_reads in replicate_outputs),
+            reverse=True
+        )
+        writers = [(fraction, open_writer(output_file, max_length, threads)) for fraction, output_file, _ in targets]
+        streams.append((seed, random.Random(seed), targets, writers))
+
+    try:
+        for record in read_fastq(input_file):
+            for _, rng, _, writers in streams:
+                draw = rng.random()
+                for fraction, writer in writers:
+                    if draw >= fraction:
+                        break
+                    write_record(writer, record)
+    except Exception:
+        for _, _, _, writers in streams:
+            for _, writer in writers:
+                abort_writer(writer)
+        raise
+
+    for seed, _, targets, writers in streams:
+        for (fraction, output_file, num_reads), (_, writer) in zip(targets, writers):
+            close_writer(writer)
+            write_manifest(output_file, {
+                "input": input_file,
+                "input_reads": input_reads,
+                "seed": seed,
+                "fraction": fraction,
+                "target_reads": num_reads,
+                "written_reads": writer["reads"],
+                "max_length": max_length,
+            })
+            logger.info(f"Wrote {writer['reads']} of {num_reads} target reads to {output_file}.")
+
+    return [output_file for output_file, _ in outputs]
+
+
+def mix_fastq(child, mother, outputs, seed, max_length=PARAMETERS["read_length"]):
+    """
+    Write every (output_file, ff, child_reads, mother_reads) in `outputs` from one concurrent
+    scan of the child and mother FASTQs, given as (input_file, input_reads). Each source keeps
+    one uniform draw per read from its own generator derived from `seed`, and the two streams
+    are interleaved in proportion to their sizes so every output is evenly mixed.
+    """
+    logger.info(f"Mixing {child[0]} and {mother[0]} into {len(outputs)} outputs with seed {seed}...")
+
+    threads = max(1, PARAMETERS["threads"] // len(outputs))
+    writers = {output_file: open_writer(output_file, max_length, threads) for output_file, _, _, _ in outputs}
+    counts = {output_file: {"child": 0, "mother": 0} for output_file, _, _, _ in outputs}
+
+    def source_targets(source, column):
+        targets = sorted(((output[column] / source[1], output[0]) for output in outputs), reverse=True)
+        return [(fraction, writers[output_file], counts[output_file]) for fraction, output_file in targets]
+
+    def take(record, rng, targets, role):
+        draw = rng.random()
+        for fraction, writer, count in targets:
+            if draw >= fraction:
+                break
+            write_record(writer, record)
+            count[role] += 1
+
+    child_rng, mother_rng = random.Random(f"{seed}:child"), random.Random(f"{seed}:mother")
+    child_targets, mother_targets = source_targets(child, 2), source_targets(mother, 3)
+    ratio = mother[1] / child[1]
+
+    try:
+        mother_records = read_fastq(mother[0])
+        credit = 0.0
+        for record in read_fastq(child[0]):
+            take(record, child_rng, child_targets, "child")
+            credit += ratio
+            while credit >= 1:
+                mother_record = next(mother_records, None)
+                if mother_record is None:
+                    break
+                take(mother_record, mother_rng, mother_targets, "mother")
+                credit -= 1
+        for record in mother_records:
+            take(record, mother_rng, mother_targets, "mother")
+    except Exception:
+        for writer in writers.values():
+            abort_writer(writer)
+        raise
+
+    for output_file, ff, child_reads, mother_reads in outputs:
+        close_writer(writers[output_file])
+        count = counts[output_file]
+        written = count["child"] + count["mother"]
+        write_manifest(output_file, {
+            "child": child[0],
+            "mother": mother[0],
+            "seed": seed,
+            "ff": ff,
+            "target_reads": {"child": child_reads, "mother": mother_reads},
+            "written_reads": count,
+            "realised_ff": count["child"] / written if written else None,
+            "max_length": max_length,
+        })
+        logger.info(f"Wrote {count['child']} child and {count['mother']} mother reads to {output_file}.")
+
+    return [output_file for output_file, _, _, _ in outputs]
@@ -21,6 +21,19 @@ def extract_lane1_fq(fq_path, r1_path):
     logger.info(f"Extracted land 1 for {fq_path}")
 
 
+def load_reference_fai(in_fai, chroms=None):
+    ref = []
+    with open(in_fai) as fh:
+        for r in fh:
+            col = r.strip().split()
+            if chroms is not None and len(chroms):
+                if col[0] in chroms:
+                    ref.append([col[0], 1, int(col[1])])
+            else:
+                ref.append([col[0], 1, int(col[1])])
+    return ref
+
+
 def save_results_to_csv(file_path, df):
     os.makedirs(os.path.dirname(file_path), exist_ok=True) 
     df.to_csv(file_path, index=True)
@@ -1,98 +1,119 @@
-import os, subprocess, random
-from helper.config import PATHS, TOOLS, PARAMETERS
+import os
+from helper.config import PATHS, PARAMETERS
 from helper.path_define import fastq_path_lane1, fastq_single_path, fastq_nipt_path
 from helper.logger import setup_logger
+from helper.metrics import get_fastq_read_count
+from helper.fastq_stream import subsample_fastq, mix_fastq, new_seed, read_manifest
 from concurrent.futures import ThreadPoolExecutor
 
 logger = setup_logger(os.path.join(PATHS["logs"], "generate.log"))
 total_reads = PARAMETERS["refsize"] / PARAMETERS["read_length"]
 
 
-def filter_and_trim_with_seqtk(input_file, output_file, num_reads, max_length=PARAMETERS["read_length"]):
-    logger.info(f"Filtering {num_reads} reads from {input_file} and trimming to {max_length}bp...")
-    print(f"Filtering {num_reads} reads from {input_file} and trimming to {max_length}bp...")
+def subsample_sample(name, replicates):
+    outputs = [output for _, replicate_outputs in replicates for output in replicate_outputs]
+    logger.info(f"Filtering {[num_reads for _, num_reads in outputs]} reads from {name} and trimming to {PARAMETERS['read_length']}bp with seeds {[seed for seed, _ in replicates]}...")
+    print(f"Filtering {[num_reads for _, num_reads in outputs]} reads from {name}...")
 
-    temp_output = output_file.replace(".fastq.gz", "_tmp.fastq.gz")
+    subsample_fastq(fastq_path_lane1(name), get_fastq_read_count(name), replicates)
 
-    if not os.path.exists(input_file):
-        logger.error(f"Sample {input_file} cannot be read.")
-        raise RuntimeError(f"Failed to read sample: {input_file}")
+    logger.info(f"Filtering and trimming done. Output saved to {[output_file for output_file, _ in outputs]}.")
+    return [output_file for output_file, _ in outputs]
 
-    seed = random.randint(1, 10**9 + 7)
 
-    cmd_sample = f"{TOOLS['seqtk']} sample -s {seed} {input_file} {num_reads} > {temp_output}"
-    subprocess.run(cmd_sample, shell=True, check=True)
+def recorded_seed(output_files):
+    # Regenerating with the seed of an earlier output keeps the nested subsets identical
+    for output_file in output_files:
+        manifest = read_manifest(output_file)
+        if manifest:
+            return manifest["seed"]
+    return None
 
-    cmd_trim = f"{TOOLS['seqtk']} trimfq -L {max_length} {temp_output} | gzip > {output_file}"
-    subprocess.run(cmd_trim, shell=True, check=True)
 
-    os.remove(temp_output)
+def replicate_outputs(name, coverages, index):
+    output_files = []
+    outputs = []
+    for coverage in coverages:
+        sample_output_dir = fastq_single_path(name, coverage, index)
+        os.makedirs(sample_output_dir, exist_ok=True)
+        output_file = os.path.join(sample_output_dir, f"{name}.fastq.gz")
+        output_files.append(output_file)
 
-    logger.info(f"Filtering and trimming done. Output saved to {output_file}.")
-    return output_file
+        if os.path.exists(output_file):
+            logger.info(f"File {output_file} already exists. Skipping creation.")
+            continue
 
+        logger.info(f"Generate sample {name} with coverage {coverage}, index {index}....")
+        outputs.append((output_file, int(coverage * total_reads)))
 
-def generate_random_reads_files(name, coverage, output_prefix):
-    input_file = fastq_path_lane1(name)
-    output_file = f"{output_prefix}.fastq.gz"
-    if os.path.exists(output_file):
-        logger.info(f"File {output_file} already exists. Skipping creation.")
-        return output_file
+    return output_files, outputs
 
-    logger.info(f"Generate sample {name} with coverage {coverage}....")
 
-    num_reads = int(coverage * total_reads)
+def generate_merge_files(child_name, mother_name, coverage, ffs, output_prefixes):
+    # Every fetal fraction of one coverage from a single interleaved scan of child and mother;
+    # outputs of a sweep share one seed so re-generating a missing one keeps its siblings consistent
+    output_files = [f"{output_prefix}.fastq.gz" for output_prefix in output_prefixes]
+    outputs = []
+    for ff, output_file in zip(ffs, output_files):
+        if os.path.exists(output_file):
+            logger.info(f"File {output_file} already exists. Skipping creation.")
+            continue
+        child_reads = int(ff * coverage * total_reads)
+        mother_reads = int((1 - ff) * coverage * total_reads)
+        outputs.append((output_file, ff, child_reads, mother_reads))
 
-    return filter_and_trim_with_seqtk(input_file, output_file, num_reads)
+    if not outputs:
+        return output_files
 
+    logger.info(f"Generate nipt samples, child {child_name} and mother {mother_name} with coverage {coverage}, ff {[ff for _, ff, _, _ in outputs]}....")
+    print(f"Mixing {child_name} and {mother_name} at fetal fractions {[ff for _, ff, _, _ in outputs]}...")
 
-def generate_merge_files(child_name, mother_name, coverage, ff, output_prefix):
-    output_file = f"{output_prefix}.fastq.gz"
-    if os.path.exists(output_file):
-        logger.info(f"File {output_file} already exists. Skipping creation.")
-        return output_file
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        child_total, mother_total = executor.map(get_fastq_read_count, [child_name, mother_name])
 
-    logger.info(f"Generate nipt sample, child {child_name} and mother {mother_name} with coverage {coverage}....")
+    mix_fastq(
+        (fastq_path_lane1(child_name), child_total),
+        (fastq_path_lane1(mother_name), mother_total),
+        outputs,
+        recorded_seed(output_files) or new_seed()
+    )
 
-    child_reads = int(ff * coverage * total_reads)
-    mother_reads = int((1 - ff) * coverage * total_reads)
+    logger.info(f"Mixing done. Output saved to {[output_file for output_file, _, _, _ in outputs]}.")
+    return output_files
 
-    child_output = f"{output_prefix}_child.fastq.gz"
-    mother_output = f"{output_prefix}_mother.fastq.gz"
 
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        executor.map(
-            filter_and_trim_with_seqtk,
-            [fastq_path_lane1(child_name), fastq_path_lane1(mother_name)],  
-            [child_output, mother_output],  
-            [child_reads, mother_reads]  
-        )
+def generate_single_sweep(name, coverages, indices):
+    # Every (coverage, index) replicate of `name` from one scan of its lane 1 FASTQ:
+    # one independent seed per index, nested coverages within an index
+    sweep = {}
+    replicates = []
+    for index in indices:
+        output_files, outputs = replicate_outputs(name, coverages, index)
+        sweep[index] = output_files
+        if outputs:
+            replicates.append((recorded_seed(output_files) or new_seed(), outputs))
 
-    cmd_merge = f"{TOOLS['zcat']} {child_output} {mother_output} | gzip > {output_file}"
-    subprocess.run(cmd_merge, shell=True, check=True)
+    if replicates:
+        subsample_sample(name, replicates)
+    return sweep
 
-    try:
-        os.remove(child_output)
-        os.remove(mother_output)
-        logger.info(f"Temporary files {child_output} and {mother_output} deleted.")
-    except OSError as e:
-        logger.error(f"Error deleting temporary files: {e}")
 
-    return output_file
+def generate_single_samples(name, coverages, index):
+    return generate_single_sweep(name, coverages, [index])[index]
 
 
 def generate_single_sample(name, coverage, index):
-    sample_output_dir = fastq_single_path(name, coverage, index)
-    os.makedirs(sample_output_dir, exist_ok=True)
-    output_prefix = os.path.join(sample_output_dir, name)
-    output_dir = generate_random_reads_files(name, coverage, output_prefix)
-    return output_dir
+    return generate_single_samples(name, [coverage], index)[0]
+
+
+def generate_nipt_samples(child_name, mother_name, father_name, coverage, ffs, index):
+    output_prefixes = []
+    for ff in ffs:
+        sample_output_dir = fastq_nipt_path(child_name, mother_name, father_name, coverage, ff, index)
+        os.makedirs(sample_output_dir, exist_ok=True)
+        output_prefixes.append(os.path.join(sample_output_dir, f"{child_name}_{mother_name}_{father_name}"))
+    return generate_merge_files(child_name, mother_name, coverage, ffs, output_prefixes)
 
 
 def generate_nipt_sample(child_name, mother_name, father_name, coverage, ff, index):
-    sample_output_dir = fastq_nipt_path(child_name, mother_name, father_name, coverage, ff, index)
-    os.makedirs(sample_output_dir, exist_ok=True)
-    output_prefix = os.path.join(sample_output_dir, f"{child_name}_{mother_name}_{father_name}")
-    output_dir = generate_merge_files(child_name, mother_name, coverage, ff, output_prefix)
-    return output_dir
- 
\ No newline at end of file
+    return generate_nipt_samples(child_name, mother_name, father_name, coverage, [ff], index)[0]
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pandas as pd
+
+# CSV column -> metric name, in the order of the last axis of GroundTruthStats.counts
+METRICS = {"Total_GT": "total_gt", "ALT_GT": "alt_gt", "HET_GT": "het_gt", "HOM_ALT": "hom_alt"}
+MAF_BINS = 51
+
+
+class GroundTruthStats:
+    """
+    Ground-truth genotype counts of genotype_stats_per_chr.csv as one dense int32 array indexed by
+    (chromosome, sample, MAF bin, metric), plus a `present` mask of the (chromosome, sample, MAF bin)
+    rows the CSV actually holds. Unknown chromosomes or samples read as empty.
+    """
+
+    def __init__(self, chromosomes, samples, counts, present):
+        self.chromosomes = list(chromosomes)
+        self.samples = list(samples)
+        self.chromosome_codes = {chromosome: i for i, chromosome in enumerate(self.chromosomes)}
+        self.sample_codes = {sample: i for i, sample in enumerate(self.samples)}
+        self.metrics = {metric: i for i, metric in enumerate(METRICS.values())}
+        self.counts = counts
+        self.present = present
+
+    def _codes(self, chromosome, sample):
+        return self.chromosome_codes.get(chromosome), self.sample_codes.get(sample)
+
+    def bins(self, chromosome, sample, metric):
+        # One metric over MAF bins 0..50, 0 where the CSV has no row
+        c, s = self._codes(chromosome, sample)
+        if c is None or s is None:
+            return np.zeros(MAF_BINS, dtype=self.counts.dtype)
+        return self.counts[c, s, :, self.metrics[metric]]
+
+    def present_bins(self, chromosome, sample):
+        c, s = self._codes(chromosome, sample)
+        if c is None or s is None:
+            return np.zeros(MAF_BINS, dtype=bool)
+        return self.present[c, s]
+
+
+def build_ground_truth_stats(csv_path):
+    df = pd.read_csv(csv_path, sep=",", dtype={"Chr": str, "Sample": str})
+    chromosomes = pd.Categorical(df["Chr"])
+    samples = pd.Categorical(df["Sample"])
+    c, s, m = chromosomes.codes, samples.codes, df["MAF"].to_numpy(dtype=np.int64)
+
+    shape = (len(chromosomes.categories), len(samples.categories), MAF_BINS)
+    counts = np.zeros(shape + (len(METRICS),), dtype=np.int32)
+    present = np.zeros(shape, dtype=bool)
+    counts[c, s, m] = df[list(METRICS)].to_numpy(dtype=np.int32)
+    present[c, s, m] = True
+    return GroundTruthStats(chromosomes.categories, samples.categories, counts, present)
+
+
+def load_ground_truth_stats(csv_path):
+    """
+    GroundTruthStats of `csv_path`, parsed once and cached as arrays in a .npz next to the CSV;
+    the cache is rebuilt whenever the CSV's size or mtime changes.
+    """
+    cache = f"{os.path.splitext(csv_path)[0]}.npz"
+    stat = os.stat(csv_path)
+    signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    if os.path.exists(cache):
+        with np.load(cache) as stored:
+            if np.array_equal(stored["signature"], signature):
+                return GroundTruthStats(stored["chromosomes"].tolist(), stored["samples"].tolist(),
+                    stored["counts"], stored["present"])
+
+    stats = build_ground_truth_stats(csv_path)
+    tmp_cache = cache.replace(".npz", ".tmp.npz")
+    np.savez(tmp_cache,
+        signature=signature,
+        chromosomes=np.array(stats.chromosomes, dtype=str),
+        samples=np.array(stats.samples, dtype=str),
+        counts=stats.counts,
+        present=stats.present,
+    )
+    os.replace(tmp_cache, cache)
+    return stats
@@ -1,11 +1,14 @@
 import os
 import subprocess
+import threading
 from helper.path_define import fastq_path_lane1
 from helper.config import TOOLS, PATHS
 from helper.logger import setup_logger
 
 
 COVERAGE_FILE = os.path.join(PATHS["fastq_directory"], "coverage.txt")
+READS_FILE = os.path.join(PATHS["fastq_directory"], "reads.txt")
+READS_LOCK = threading.Lock()
 logger = setup_logger(os.path.join(PATHS["logs"], "metrics.log"))
 
 def get_fastq_coverage(name):
@@ -41,3 +44,41 @@ def get_fastq_coverage(name):
     return coverage
 
 
+def recorded_read_count(name):
+    if os.path.exists(READS_FILE):
+        with open(READS_FILE, 'r') as f:
+            for line in f:
+                sample, reads = line.strip().split('\t')
+                if sample == name:
+                    return int(reads)
+    return None
+
+
+def record_read_count(name, reads):
+    # Callers count different samples from several threads, so reads.txt is checked and appended under a lock
+    with READS_LOCK:
+        if recorded_read_count(name) is None:
+            with open(READS_FILE, 'a') as f:
+                f.write(f"{name}\t{reads}\n")
+
+
+def get_fastq_read_count(name):
+    with READS_LOCK:
+        reads = recorded_read_count(name)
+    if reads is not None:
+        return reads
+
+    input_fastq = fastq_path_lane1(name)
+    result = subprocess.run([TOOLS['seqkit'], "stats", "-T", input_fastq], capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.error(f"seqkit stats failed for {input_fastq}: {result.stderr.strip()}")
+        raise RuntimeError(f"Failed to count reads of {input_fastq}")
+
+    stats_values = result.stdout.strip().split('\n')[-1].split('\t')
+
+    if len(stats_values) < 5:
+        raise ValueError("Segkit error!")
+
+    reads = int(stats_values[3])
+    record_read_count(name, reads)
+    return reads
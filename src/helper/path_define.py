@@ -19,6 +19,9 @@ def fastq_single_path(name, coverage, index=1):
 def fastq_nipt_path(child, mother, father, coverage, ff, index=1):
     return os.path.join(PATHS["result_directory"], f"{coverage}x", f"{child}_{mother}_{father}", f"{ff:.2f}", f"sample_{index}")
 
+def fastq_manifest(fq):
+    return fq.replace(".fastq.gz", ".manifest.json")
+
 def base_dir(fq):
     return os.path.dirname(fq)
 
@@ -34,6 +37,18 @@ def batch1_final_outdir(fq):
 def bam_dir(fq):
     return os.path.join(batch1_final_outdir(fq), f"{samid(fq)}.sorted.rmdup.realign.BQSR.bam")
 
+def rmdup_bam_path(sample_id, outdir):
+    return os.path.join(outdir, f"{sample_id}.sorted.rmdup.bam")
+
+def bqsr_bam_path(sample_id, outdir):
+    return os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bam")
+
+def cvg_bed_path(sample_id, outdir):
+    return os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.cvg.bed.gz")
+
+def cvg_npz_path(sample_id, outdir):
+    return os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.cvg.npz")
+
 def bamlist_dir(fq):
     return os.path.join(batch1_final_outdir(fq), "bam.list")
 
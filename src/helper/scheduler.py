@@ -0,0 +1,126 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from helper.config import PARAMETERS, PATHS
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "scheduler.log"))
+
+THREADS = PARAMETERS["threads"]
+MEMORY = PARAMETERS["memory"]
+
+
+def tool_cost(tool):
+    # Declared (threads, memory in GB) of one tool invocation, capped to the global budget
+    cost = PARAMETERS["resources"].get(tool, {}) if tool else {}
+    return min(cost.get("threads", 1), THREADS), min(cost.get("memory", 0), MEMORY)
+
+
+class Task:
+    def __init__(self, name, func, args=(), deps=(), inputs=(), outputs=(), tool=None, threads=None, memory=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+        tool_threads, tool_memory = tool_cost(tool)
+        self.threads = min(threads, THREADS) if threads is not None else tool_threads
+        self.memory = min(memory, MEMORY) if memory is not None else tool_memory
+
+
+def scope_tasks(tasks, scope):
+    # Prefix the names of `tasks`, and their dependencies on each other, with `scope`, so
+    # several copies of one per-sample graph can share a single run_tasks call
+    names = {task.name for task in tasks}
+    for task in tasks:
+        task.deps = [f"{scope}/{dep}" if dep in names else dep for dep in task.deps]
+        task.name = f"{scope}/{task.name}"
+    return tasks
+
+
+def _propagate_failures(pending, failed):
+    changed = True
+    while changed:
+        changed = False
+        for name, task in list(pending.items()):
+            if any(dep in failed for dep in task.deps):
+                logger.error(f"Skip task {name}: an upstream task failed.")
+                failed.add(name)
+                del pending[name]
+                changed = True
+
+
+def run_tasks(tasks):
+    pending = {}
+    for task in tasks:
+        if task.name in pending:
+            raise ValueError(f"Duplicate task name: {task.name}")
+        pending[task.name] = task
+
+    for task in pending.values():
+        for dep in task.deps:
+            if dep not in pending:
+                raise ValueError(f"Task {task.name} depends on unknown task {dep}")
+
+    running = {}
+    done, failed = set(), set()
+    free_threads, free_memory = THREADS, MEMORY
+
+    logger.info(f"Scheduling {len(pending)} tasks with {THREADS} threads and {MEMORY}G memory")
+
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+        while pending or running:
+            _propagate_failures(pending, failed)
+
+            # Step 1: Launch every ready task that fits in the remaining budget
+            for name, task in list(pending.items()):
+                if not all(dep in done for dep in task.deps):
+                    continue
+                if task.threads > free_threads or task.memory > free_memory:
+                    continue
+
+                missing = [path for path in task.inputs if not os.path.exists(path)]
+                if missing:
+                    logger.error(f"Task {name} is missing inputs: {missing}")
+                    failed.add(name)
+                    del pending[name]
+                    continue
+
+                logger.info(f"Start task {name} ({task.threads} threads, {task.memory}G)")
+                free_threads -= task.threads
+                free_memory -= task.memory
+                running[executor.submit(task.func, *task.args)] = task
+                del pending[name]
+
+            if not running:
+                _propagate_failures(pending, failed)
+                if pending:
+                    raise RuntimeError(f"Dependency cycle between tasks: {sorted(pending)}")
+                break
+
+            # Step 2: Wait for any task to finish and release its budget
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                free_threads += task.threads
+                free_memory += task.memory
+
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Task {task.name} failed: {e}")
+                    failed.add(task.name)
+                    continue
+
+                missing = [path for path in task.outputs if not os.path.exists(path)]
+                if missing:
+                    logger.error(f"Task {task.name} did not produce: {missing}")
+                    failed.add(task.name)
+                    continue
+
+                logger.info(f"Done task {task.name}")
+                done.add(task.name)
+
+    if failed:
+        raise RuntimeError(f"Failed tasks: {sorted(failed)}")
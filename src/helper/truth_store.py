@@ -0,0 +1,184 @@
+import os, json, shutil, hashlib
+import numpy as np
+from cyvcf2 import VCF
+from helper.config import PATHS, TRIO_DATA
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "truth_store.log"))
+
+STORE_DIR = PATHS.get("truth_store_directory", os.path.join(PATHS["result_directory"], "truth_store"))
+BLOCK_SIZE = 10000
+MIN_MAF = 0.001
+# Bumped whenever the on-disk encoding changes, so stores built by older code are rebuilt
+STORE_VERSION = 2
+
+# Genotypes are stored as allele-set bitmasks: bit a is set when allele a (capped at 6) is called,
+# so two calls compare equal exactly when their allele sets do; 0 means no called allele
+HOM_REF = 1
+NO_CALL = 0
+
+
+def allele_hash(ref, alt):
+    digest = hashlib.blake2b(f"{ref}>{alt}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def genotype_codes(alleles):
+    # alleles: (..., 2) integer array, negative for missing
+    valid = alleles >= 0
+    bits = np.where(valid, np.left_shift(1, np.clip(alleles, 0, 6)), 0)
+    return np.bitwise_or.reduce(bits, axis=-1).astype(np.int8)
+
+
+def allele_columns(genotype_array):
+    # cyvcf2 genotype.array() rows [allele, ..., phased] -> (samples, 2) alleles; the phase
+    # column is dropped and haploid calls get a missing second allele
+    alleles = genotype_array[:, :-1]
+    if alleles.shape[1] < 2:
+        alleles = np.pad(alleles, ((0, 0), (0, 2 - alleles.shape[1])), constant_values=-1)
+    return alleles[:, :2]
+
+
+def genotype_code(genotype):
+    # One cyvcf2 genotype [allele, ..., phased]; the trailing phase flag is not an allele
+    if genotype is None:
+        return None
+    alleles = (list(genotype[:-1]) + [-1, -1])[:2]
+    return int(genotype_codes(np.array(alleles, dtype=np.int16)))
+
+
+class TruthStore:
+    """
+    Ground truth of one chromosome: sorted positions, REF>ALT hashes and MAF bins per variant
+    plus an int8 variants x samples genotype matrix, all memory-mapped from `directory`.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.samples = self.meta["samples"]
+        self.columns = {sample: i for i, sample in enumerate(self.samples)}
+        self.pos = np.load(os.path.join(directory, "pos.npy"), mmap_mode="r")
+        self.alleles = np.load(os.path.join(directory, "alleles.npy"), mmap_mode="r")
+        self.maf = np.load(os.path.join(directory, "maf.npy"), mmap_mode="r")
+        shape = (len(self.pos), len(self.samples))
+        self.gt = np.memmap(os.path.join(directory, "gt.bin"), dtype=np.int8, mode="r", shape=shape) \
+            if all(shape) else np.zeros(shape, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def find(self, pos, ref, alt):
+        # Row of the variant at `pos` with these alleles, or -1
+        row = int(np.searchsorted(self.pos, pos))
+        key = allele_hash(ref, alt)
+        while row < len(self.pos) and self.pos[row] == pos:
+            if self.alleles[row] == key:
+                return row
+            row += 1
+        return -1
+
+    def find_rows(self, positions, hashes, lo=0, hi=None):
+        # Vectorised find(): rows of many (position, allele hash) pairs, -1 where absent.
+        # lo/hi restrict the search to a window of rows already known to hold the positions
+        pos, alleles = self.pos[lo:hi], self.alleles[lo:hi]
+        rows = np.full(len(positions), -1, dtype=np.int64)
+        candidates = np.searchsorted(pos, positions)
+        while True:
+            in_range = candidates < len(pos)
+            same_pos = np.zeros(len(positions), dtype=bool)
+            same_pos[in_range] = pos[candidates[in_range]] == positions[in_range]
+            if not same_pos.any():
+                return np.where(rows >= 0, rows + lo, -1)
+            hit = same_pos & (rows < 0)
+            hit[hit] = alleles[candidates[hit]] == hashes[hit]
+            rows[hit] = candidates[hit]
+            candidates += 1
+
+    def window(self, start, end):
+        # Row range [lo, hi) of the variants with start <= POS <= end
+        lo, hi = np.searchsorted(self.pos, [start, end + 1])
+        return int(lo), int(hi)
+
+    def column(self, sample_name):
+        return self.columns.get(sample_name, -1)
+
+
+def build_truth_store(vcf_path, directory, samples=None):
+    """
+    Parse `vcf_path` once into a TruthStore under `directory`, keeping variants with a valid AF
+    and MAF >= MIN_MAF. `samples` restricts the genotype matrix to those columns.
+    """
+    tmp_dir = f"{directory}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    vcf = VCF(vcf_path, samples=samples, lazy=True)
+    positions, hashes, mafs = [], [], []
+    block = []
+    logger.info(f"Building truth store for {vcf_path} with {len(vcf.samples)} samples")
+
+    with open(os.path.join(tmp_dir, "gt.bin"), "wb") as gt_out:
+        def flush():
+            if block:
+                gt_out.write(genotype_codes(np.stack(block)).tobytes())
+                block.clear()
+
+        for record in vcf:
+            af = record.INFO.get("AF", -1)
+            if af is None or not (0 <= af <= 1):
+                continue
+            maf = min(af, 1 - af)
+            if maf < MIN_MAF:
+                continue
+
+            positions.append(record.POS)
+            hashes.append(allele_hash(record.REF, record.ALT[0]))
+            mafs.append(int(maf * 100))
+            block.append(allele_columns(record.genotype.array()))
+            if len(block) >= BLOCK_SIZE:
+                flush()
+        flush()
+
+    # Records of a tabix-indexed VCF are already sorted by position, which searchsorted relies on
+    np.save(os.path.join(tmp_dir, "pos.npy"), np.array(positions, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "alleles.npy"), np.array(hashes, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "maf.npy"), np.array(mafs, dtype=np.int8))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"vcf": vcf_path, "samples": list(vcf.samples), "variants": len(positions)}, f, indent=4)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmp_dir, directory)
+    logger.info(f"Truth store for {vcf_path} saved to {directory}: {len(positions)} variants")
+    return directory
+
+
+def trio_samples():
+    return sorted({trio_info[member] for trio_info in TRIO_DATA.values() for member in ("father", "mother", "child")})
+
+
+def store_key(vcf_path, samples=None):
+    # The store is rebuilt whenever the VCF or its index is replaced, or the sample subset changes
+    description = {"samples": sorted(samples) if samples is not None else None, "min_maf": MIN_MAF, "version": STORE_VERSION}
+    for path in (vcf_path, f"{vcf_path}.tbi"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            description[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    encoded = json.dumps(description, sort_keys=True).encode()
+    return hashlib.blake2b(encoded, digest_size=10).hexdigest()
+
+
+def load_truth_store(vcf_path, samples=None):
+    """
+    TruthStore of `vcf_path` restricted to `samples` (every sample when None), built on the
+    first call and reused from disk until the VCF, its .tbi or the sample subset changes.
+    """
+    name = os.path.basename(vcf_path).replace(".vcf.gz", "")
+    directory = os.path.join(STORE_DIR, f"{name}-{store_key(vcf_path, samples)}")
+
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        os.makedirs(STORE_DIR, exist_ok=True)
+        build_truth_store(vcf_path, directory, samples)
+    else:
+        logger.info(f"Loading cached truth store {directory}")
+    return TruthStore(directory)
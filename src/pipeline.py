@@ -1,9 +1,9 @@
 import os, sys, argparse
-from steps.alignment import run_multiple_alignment
-from steps.basevar import run_basevar
-from steps.glimpse import run_glimpse
+from steps.alignment import multiple_alignment_tasks
+from steps.basevar import basevar_tasks
+from steps.glimpse import glimpse_tasks
 from steps.reference_panel_prepare import run_prepare_reference_panel
-from helper.config import PARAMETERS
+from helper.scheduler import run_tasks
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -23,17 +23,12 @@ def main():
     fqlist = args.input_path
     print(f"Start pipeline for samples in {fqlist}...")
 
-    # Step 1: Alignment and statistics
-    print(f"Start alignment for {fqlist}...")
-    run_multiple_alignment(fqlist)
+    # Step 1: Alignment and statistics, every sample concurrently under the shared budget
+    alignment = multiple_alignment_tasks(fqlist)
 
-    # Step2: SNP detection and allele frequency estimation
-    print(f"Start basevar for {fqlist}...")
-    run_basevar(fqlist)
-
-    # Step3: Genotype imputation
-    print(f"Start glimpse for {fqlist}...")
-    run_glimpse(fqlist)
+    # Step 2: SNP detection and allele frequency estimation, concurrently with
+    # Step 3: Genotype imputation, both per chromosome once the bam.list exists
+    run_tasks(alignment + basevar_tasks(fqlist, ["alignment"]) + glimpse_tasks(fqlist, ["alignment"]))
 
     print(f"Done pipeline for sample in {fqlist}.")
 if __name__ == "__main__":
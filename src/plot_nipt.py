@@ -1,4 +1,5 @@
 from helper.config import PARAMETERS, TRIO_DATA, PATHS
+from helper.ground_truth_stats import load_ground_truth_stats
 from helper.path_define import statistic_outdir, fastq_nipt_path, statistic_summary
 
 import os
@@ -7,148 +8,49 @@ from collections import defaultdict
 import matplotlib.pyplot as plt
 import numpy as np
 
-def load_ground_truth_stats(path):
-    # Load ground truth file into dictionary with structure: gt_stats[chr][sample][maf] = stats dict
-    df = pd.read_csv(path, sep=",")
-    gt_stats = defaultdict(lambda: defaultdict(dict))
-    for _, row in df.iterrows():
-        chr_, sample, maf = str(row["Chr"]), row["Sample"], int(row["MAF"])
-        gt_stats[chr_][sample][maf] = {
-            "total_gt": row["Total_GT"],
-            "alt_gt": row["ALT_GT"],
-            "het_gt": row["HET_GT"],
-            "hom_alt": row["HOM_ALT"]
-        }
-    return gt_stats
+COUNT_COLUMNS = {
+    prefix: [f"{prefix}_both_correct", f"{prefix}_mom_correct", f"{prefix}_child_correct",
+        f"{prefix}_mom_correct_child_wrong", f"{prefix}_child_correct_mom_wrong", f"{prefix}_both_wrong"]
+    for prefix in ["gt", "alt"]
+}
+MAF_BINS = np.arange(0, 51)
 
 
-def compute_bin_stats(df, gt_stats, chr_, mother, child):
-    rows = []
-    for maf in range(0, 51):
-        gt_both_correct = df.at[maf, "gt_both_correct"]
-        gt_mom_correct = df.at[maf, "gt_mom_correct"]
-        gt_child_correct = df.at[maf, "gt_child_correct"]
-        gt_mom_correct_child_wrong = df.at[maf, "gt_mom_correct_child_wrong"]
-        gt_child_correct_mom_wrong = df.at[maf, "gt_child_correct_mom_wrong"]
-        gt_both_wrong = df.at[maf, "gt_both_wrong"]
-        gt_mom_wrong = gt_both_wrong + gt_child_correct_mom_wrong
-        gt_child_wrong = gt_both_wrong + gt_mom_correct_child_wrong
-
-        alt_both_correct = df.at[maf, "alt_both_correct"]
-        alt_mom_correct = df.at[maf, "alt_mom_correct"]
-        alt_child_correct = df.at[maf, "alt_child_correct"]
-        alt_mom_correct_child_wrong = df.at[maf, "alt_mom_correct_child_wrong"]
-        alt_child_correct_mom_wrong = df.at[maf, "alt_child_correct_mom_wrong"]
-        alt_both_wrong = df.at[maf, "alt_both_wrong"]
-        alt_mom_wrong = alt_both_wrong + alt_child_correct_mom_wrong
-        alt_child_wrong = alt_both_wrong + alt_mom_correct_child_wrong
-        
+def reverse_cumsum(values):
+    # Row t holds the sum of rows t..end, i.e. every MAF bin >= t
+    return np.cumsum(values[::-1], axis=0)[::-1]
 
-        mother_info = gt_stats.get(chr_, {}).get(mother, {}).get(maf, None)
-        if mother_info is None:
-            continue
-        total_gt_mother = mother_info["total_gt"]
-        total_alt_mother = mother_info["alt_gt"]
 
-        child_info = gt_stats.get(chr_, {}).get(child, {}).get(maf, None)
-        if child_info is None:
-            continue
-        total_gt_child = child_info["total_gt"]
-        total_alt_child = child_info["alt_gt"]
-
-        rows.append({
-            "NST": chr_,
-            "MAF": maf,
-
-            "gt_both_correct": gt_both_correct,
-            "gt_mom_correct": gt_mom_correct,
-            "gt_child_correct": gt_child_correct,
-            "gt_mom_correct_child_wrong": gt_mom_correct_child_wrong,
-            "gt_child_correct_mom_wrong": gt_child_correct_mom_wrong,
-            "gt_both_wrong": gt_both_wrong,
-            "gt_mom_wrong": gt_mom_wrong,
-            "gt_child_wrong": gt_child_wrong,
-            "total_gt_child": total_gt_child,
-            "total_gt_mother": total_gt_mother,
-            
-            "alt_both_correct": alt_both_correct,
-            "alt_mom_correct": alt_mom_correct,
-            "alt_child_correct": alt_child_correct,
-            "alt_mom_correct_child_wrong": alt_mom_correct_child_wrong,
-            "alt_child_correct_mom_wrong": alt_child_correct_mom_wrong,
-            "alt_both_wrong": alt_both_wrong,
-            "alt_mom_wrong": alt_mom_wrong,
-            "alt_child_wrong": alt_child_wrong,
-            "total_alt_child": total_alt_child,
-            "total_alt_mother": total_alt_mother,
-        })
-    return pd.DataFrame(rows)
+def nipt_frame(chr_, key, keys, counts, mother_totals, child_totals):
+    # counts: {prefix: (rows x 6) array in COUNT_COLUMNS order}; totals: (total_gt, alt_gt) arrays
+    data = {"NST": chr_, key: keys}
+    for prefix, totals_index in [("gt", 0), ("alt", 1)]:
+        values = counts[prefix]
+        for i, column in enumerate(COUNT_COLUMNS[prefix]):
+            data[column] = values[:, i]
+        data[f"{prefix}_mom_wrong"] = values[:, 5] + values[:, 4]
+        data[f"{prefix}_child_wrong"] = values[:, 5] + values[:, 3]
+        data[f"total_{prefix}_child"] = child_totals[totals_index]
+        data[f"total_{prefix}_mother"] = mother_totals[totals_index]
+    return pd.DataFrame(data)
+
+
+def compute_bin_stats(df, gt_stats, chr_, mother, child):
+    present = gt_stats.present_bins(chr_, mother) & gt_stats.present_bins(chr_, child)
+    mother_totals = (gt_stats.bins(chr_, mother, "total_gt")[present], gt_stats.bins(chr_, mother, "alt_gt")[present])
+    child_totals = (gt_stats.bins(chr_, child, "total_gt")[present], gt_stats.bins(chr_, child, "alt_gt")[present])
+
+    counts = {prefix: df.loc[MAF_BINS, columns].to_numpy()[present] for prefix, columns in COUNT_COLUMNS.items()}
+    return nipt_frame(chr_, "MAF", MAF_BINS[present], counts, mother_totals, child_totals)
 
 
 def compute_cumsum_stats(df, gt_stats, chr_, mother, child):
-    rows = []
-    for threshold in range(0, 51):
-        gt_both_correct = df.loc[threshold:50, "gt_both_correct"].sum()
-        gt_mom_correct = df.loc[threshold:50, "gt_mom_correct"].sum()
-        gt_child_correct = df.loc[threshold:50, "gt_child_correct"].sum()
-        gt_mom_correct_child_wrong = df.loc[threshold:50, "gt_mom_correct_child_wrong"].sum()
-        gt_child_correct_mom_wrong = df.loc[threshold:50, "gt_child_correct_mom_wrong"].sum()
-        gt_both_wrong = df.loc[threshold:50, "gt_both_wrong"].sum()
-        gt_mom_wrong = gt_both_wrong + gt_child_correct_mom_wrong
-        gt_child_wrong = gt_both_wrong + gt_mom_correct_child_wrong
-
-        alt_both_correct = df.loc[threshold:50, "alt_both_correct"].sum()
-        alt_mom_correct = df.loc[threshold:50, "alt_mom_correct"].sum()
-        alt_child_correct = df.loc[threshold:50, "alt_child_correct"].sum()
-        alt_mom_correct_child_wrong = df.loc[threshold:50, "alt_mom_correct_child_wrong"].sum()
-        alt_child_correct_mom_wrong = df.loc[threshold:50, "alt_child_correct_mom_wrong"].sum()
-        alt_both_wrong = df.loc[threshold:50, "alt_both_wrong"].sum()
-        alt_mom_wrong = alt_both_wrong + alt_child_correct_mom_wrong
-        alt_child_wrong = alt_both_wrong + alt_mom_correct_child_wrong
-
-        total_gt_mother = 0
-        alt_gt_mother = 0
-        total_gt_child = 0
-        alt_gt_child = 0
-
-        for maf in range(threshold, 51):
-            stats_mother = gt_stats.get(chr_, {}).get(mother, {}).get(maf, None)
-            if stats_mother:
-                total_gt_mother += stats_mother["total_gt"]
-                alt_gt_mother += stats_mother["alt_gt"]
-
-            stats_child = gt_stats.get(chr_, {}).get(child, {}).get(maf, None)
-            if stats_child:
-                total_gt_child += stats_child["total_gt"]
-                alt_gt_child += stats_child["alt_gt"]
-
-        rows.append({
-            "NST": chr_,
-            "MAF_≥": threshold,
-
-            "gt_both_correct": gt_both_correct,
-            "gt_mom_correct": gt_mom_correct,
-            "gt_child_correct": gt_child_correct,
-            "gt_mom_correct_child_wrong": gt_mom_correct_child_wrong,
-            "gt_child_correct_mom_wrong": gt_child_correct_mom_wrong,
-            "gt_both_wrong": gt_both_wrong,
-            "gt_mom_wrong": gt_mom_wrong,
-            "gt_child_wrong": gt_child_wrong,
-            "total_gt_child": total_gt_child,
-            "total_gt_mother": total_gt_mother,
-            
-            "alt_both_correct": alt_both_correct,
-            "alt_mom_correct": alt_mom_correct,
-            "alt_child_correct": alt_child_correct,
-            "alt_mom_correct_child_wrong": alt_mom_correct_child_wrong,
-            "alt_child_correct_mom_wrong": alt_child_correct_mom_wrong,
-            "alt_both_wrong": alt_both_wrong,
-            "alt_mom_wrong": alt_mom_wrong,
-            "alt_child_wrong": alt_child_wrong,
-            "total_alt_child": alt_gt_child,
-            "total_alt_mother": alt_gt_mother,
-        })
-    return pd.DataFrame(rows)
+    # Bins missing from the ground truth read as 0, so the totals only sum the bins it holds
+    mother_totals = (reverse_cumsum(gt_stats.bins(chr_, mother, "total_gt")), reverse_cumsum(gt_stats.bins(chr_, mother, "alt_gt")))
+    child_totals = (reverse_cumsum(gt_stats.bins(chr_, child, "total_gt")), reverse_cumsum(gt_stats.bins(chr_, child, "alt_gt")))
+
+    counts = {prefix: reverse_cumsum(df.loc[MAF_BINS, columns].to_numpy()) for prefix, columns in COUNT_COLUMNS.items()}
+    return nipt_frame(chr_, "MAF_≥", MAF_BINS, counts, mother_totals, child_totals)
 
 def process_summary(df_path, gt_stats, chr_, mother, child):
     df = pd.read_csv(df_path)
@@ -1,10 +1,11 @@
 from helper.config import PARAMETERS, TRIO_DATA, PATHS
+from helper.ground_truth_stats import load_ground_truth_stats
 from helper.path_define import fastq_single_path, statistic_summary
 
 import os
 import pandas as pd
-from collections import defaultdict
 import matplotlib.pyplot as plt
+import numpy as np
 
 def sort_nst(nst):
     if nst == "chrX":
@@ -17,18 +18,6 @@ def sort_nst(nst):
         num = int(nst.replace("chr", ""))
         return (num, "")
 
-def load_ground_truth_stats(path):
-    df = pd.read_csv(path, sep=",")
-    gt_stats = defaultdict(lambda: defaultdict(dict))
-    for _, row in df.iterrows():
-        chr_, sample, maf = str(row["Chr"]), row["Sample"], int(row["MAF"])
-        gt_stats[chr_][sample][maf] = {
-            "total_gt": row["Total_GT"],
-            "alt_gt": row["ALT_GT"],
-        }
-    return gt_stats
-
-
 def recal_stats(df):
     df['call_rate_gt'] = (df['GT_true'] + df['GT_false']) / df['total_GT']
     df['accuracy_gt'] = df['GT_true'] / (df['GT_true'] + df['GT_false'])
@@ -39,63 +28,36 @@ def recal_stats(df):
     return df
 
 
-def compute_bin_stats(df, gt_stats, chr_, sample, method):
-    rows = []
-    for maf in range(0, 51):
-        gt_true = df.at[maf, f"{method}_GT_true"]
-        gt_false = df.at[maf, f"{method}_GT_false"]
-        alt_true = df.at[maf, f"{method}_ALT_true"]
-        alt_false = df.at[maf, f"{method}_ALT_false"]
-
-        gt_info = gt_stats.get(chr_, {}).get(sample, {}).get(maf, None)
-        if gt_info is None:
-            continue
+COUNT_COLUMNS = ["GT_true", "GT_false", "ALT_true", "ALT_false"]
+MAF_BINS = np.arange(0, 51)
+
 
-        total_gt = gt_info["total_gt"]
-        alt_gt = gt_info["alt_gt"]
+def reverse_cumsum(values):
+    # Row t holds the sum of rows t..end, i.e. every MAF bin >= t
+    return np.cumsum(values[::-1], axis=0)[::-1]
 
-        rows.append({
-            "NST": chr_,
-            "MAF": maf,
-            "GT_true": gt_true,
-            "GT_false": gt_false,
-            "ALT_true": alt_true,
-            "ALT_false": alt_false,
-            "total_GT": total_gt,
-            "total_ALT": alt_gt,
-        })
 
-    return pd.DataFrame(rows)
+def single_frame(chr_, key, keys, counts, total_gt, alt_gt):
+    data = {"NST": chr_, key: keys}
+    for i, column in enumerate(COUNT_COLUMNS):
+        data[column] = counts[:, i]
+    data["total_GT"] = total_gt
+    data["total_ALT"] = alt_gt
+    return pd.DataFrame(data)
+
+
+def compute_bin_stats(df, gt_stats, chr_, sample, method):
+    present = gt_stats.present_bins(chr_, sample)
+    counts = df.loc[MAF_BINS, [f"{method}_{column}" for column in COUNT_COLUMNS]].to_numpy()[present]
+    return single_frame(chr_, "MAF", MAF_BINS[present], counts,
+        gt_stats.bins(chr_, sample, "total_gt")[present], gt_stats.bins(chr_, sample, "alt_gt")[present])
 
 
 def compute_cumsum_stats(df, gt_stats, chr_, sample, method):
-    rows = []
-    for threshold in range(0, 51):
-        gt_true = df.loc[threshold:50, f"{method}_GT_true"].sum()
-        gt_false = df.loc[threshold:50, f"{method}_GT_false"].sum()
-        alt_true = df.loc[threshold:50, f"{method}_ALT_true"].sum()
-        alt_false = df.loc[threshold:50, f"{method}_ALT_false"].sum()
-
-        total_gt = 0
-        alt_gt = 0
-        for maf in range(threshold, 51):
-            stats = gt_stats.get(chr_, {}).get(sample, {}).get(maf, None)
-            if stats:
-                total_gt += stats["total_gt"]
-                alt_gt += stats["alt_gt"]
-
-        rows.append({
-            "NST": chr_,
-            "MAF_≥": threshold,
-            "GT_true": gt_true,
-            "GT_false": gt_false,
-            "ALT_true": alt_true,
-            "ALT_false": alt_false,
-            "total_GT": total_gt,
-            "total_ALT": alt_gt
-        })
-
-    return pd.DataFrame(rows)
+    # Bins missing from the ground truth read as 0, so the totals only sum the bins it holds
+    counts = reverse_cumsum(df.loc[MAF_BINS, [f"{method}_{column}" for column in COUNT_COLUMNS]].to_numpy())
+    return single_frame(chr_, "MAF_≥", MAF_BINS, counts,
+        reverse_cumsum(gt_stats.bins(chr_, sample, "total_gt")), reverse_cumsum(gt_stats.bins(chr_, sample, "alt_gt")))
 
 
 def recheck_basevar_merge(output_dir=os.path.join(PATHS["plot_directory"]), coverage=0.1, index=1):
@@ -109,11 +71,7 @@ def recheck_basevar_merge(output_dir=os.path.join(PATHS["plot_directory"]), cove
         df = pd.read_csv(file_path)
         df["NST"] = chr_id
 
-        def compute_total_alt(sample):
-            maf_dict = gt_stats.get(chr_id, {}).get(sample, {})
-            return sum(m["alt_gt"] for m in maf_dict.values())
-
-        df["total_alt"] = df["Sample"].apply(compute_total_alt)
+        df["total_alt"] = df["Sample"].apply(lambda sample: gt_stats.bins(chr_id, sample, "alt_gt").sum())
         df["call_rate"] = (df["ALT_correct"] + df["ALT_wrong"]) / df["total_alt"]
         df["accuracy"] = df["ALT_correct"] / (df["ALT_correct"] + df["ALT_wrong"])
 
@@ -0,0 +1,67 @@
+import subprocess
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_ROWS = 5_000_000
+THREADS = 4
+
+
+def read_bedgraph(filepath, threads=THREADS):
+    # bgzip decompresses on several threads while pandas parses fixed-size columnar chunks
+    process = subprocess.Popen(["bgzip", "-dc", "-@", str(threads), filepath], stdout=subprocess.PIPE)
+    try:
+        for chunk in pd.read_csv(process.stdout, sep="\t", header=None, names=["chrom", "start", "end", "cov"],
+                dtype={"chrom": str, "start": np.int64, "end": np.int64, "cov": np.int64},
+                chunksize=CHUNK_ROWS, engine="c"):
+            yield chunk
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"Failed to decompress {filepath}")
+
+
+def compute_avg_cov_per_chrom(filepath):
+    total_cov = {}
+    total_len = {}
+
+    for chunk in read_bedgraph(filepath):
+        codes, chroms = pd.factorize(chunk["chrom"])
+        length = (chunk["end"] - chunk["start"]).to_numpy()
+        cov_sums = np.bincount(codes, weights=chunk["cov"].to_numpy() * length)
+        len_sums = np.bincount(codes, weights=length)
+        for chrom, cov_sum, len_sum in zip(chroms, cov_sums, len_sums):
+            total_cov[chrom] = total_cov.get(chrom, 0) + cov_sum
+            total_len[chrom] = total_len.get(chrom, 0) + len_sum
+
+    return {
+        chrom: total_cov[chrom] / total_len[chrom]
+        for chrom in total_cov
+    }
+
+
+def compute_avg_cov_per_bin(filepath, bin_size=5_000_000):
+    # Bins are keyed by midpoint // bin_size across all chromosomes, as before
+    bin_cov = np.zeros(0)
+    bin_len = np.zeros(0)
+
+    for chunk in read_bedgraph(filepath):
+        start, end = chunk["start"].to_numpy(), chunk["end"].to_numpy()
+        length = end - start
+        bin_index = ((start + end) // 2) // bin_size
+
+        size = max(len(bin_cov), int(bin_index.max()) + 1)
+        bin_cov = np.pad(bin_cov, (0, size - len(bin_cov)))
+        bin_len = np.pad(bin_len, (0, size - len(bin_len)))
+        bin_cov += np.bincount(bin_index, weights=chunk["cov"].to_numpy() * length, minlength=size)
+        bin_len += np.bincount(bin_index, weights=length, minlength=size)
+
+    present = np.flatnonzero(bin_len)
+    return dict(zip(present.tolist(), (bin_cov[present] / bin_len[present]).tolist()))
+
+
+def compute_all(file_paths, compute, **kwargs):
+    # Every coverage file at once; returns {label: result} in the order of file_paths
+    with ThreadPoolExecutor(max_workers=len(file_paths)) as executor:
+        futures = {label: executor.submit(compute, path, **kwargs) for label, path in file_paths.items()}
+        return {label: future.result() for label, future in futures.items()}
@@ -1,24 +1,5 @@
-import gzip
 import matplotlib.pyplot as plt
-from collections import defaultdict
-
-def compute_avg_cov_per_chrom(filepath):
-    total_cov = defaultdict(int)
-    total_len = defaultdict(int)
-
-    with gzip.open(filepath, 'rt') as f:
-        for line in f:
-            chrom, start, end, cov = line.strip().split('\t')
-            start, end, cov = int(start), int(end), int(cov)
-            length = end - start
-            total_cov[chrom] += cov * length
-            total_len[chrom] += length
-
-    avg_cov = {
-        chrom: total_cov[chrom] / total_len[chrom]
-        for chrom in total_cov
-    }
-    return avg_cov
+from bedgraph_reader import compute_avg_cov_per_chrom, compute_all
 
 file_paths = {
     "0.1x": "0.1x.coverage.bed.gz",
@@ -27,10 +8,7 @@ file_paths = {
     "1x":   "1x.coverage.bed.gz"
 }
 
-all_results = {
-    label: compute_avg_cov_per_chrom(path)
-    for label, path in file_paths.items()
-}
+all_results = compute_all(file_paths, compute_avg_cov_per_chrom)
 
 all_chroms = sorted(set(chrom for result in all_results.values() for chrom in result))
 plot_data = {
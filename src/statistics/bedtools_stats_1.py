@@ -1,28 +1,7 @@
-import gzip
 import matplotlib.pyplot as plt
-from collections import defaultdict
+from bedgraph_reader import compute_avg_cov_per_bin, compute_all
 import numpy as np
 
-def compute_avg_cov_per_bin(filepath, bin_size=5_000_000):
-    bin_cov = defaultdict(int)
-    bin_len = defaultdict(int)
-
-    with gzip.open(filepath, 'rt') as f:
-        for line in f:
-            chrom, start, end, cov = line.strip().split('\t')
-            start, end, cov = int(start), int(end), int(cov)
-            length = end - start
-            midpoint = (start + end) // 2
-            bin_index = midpoint // bin_size
-            bin_cov[bin_index] += cov * length
-            bin_len[bin_index] += length
-
-    avg_cov = {
-        bin_index: bin_cov[bin_index] / bin_len[bin_index]
-        for bin_index in bin_cov
-    }
-    return avg_cov
-
 file_paths = {
     "0.1x": "0.1x.coverage.bed.gz",
     "0.2x": "0.2x.coverage.bed.gz",
@@ -30,10 +9,7 @@ file_paths = {
     "1x":   "1x.coverage.bed.gz"
 }
 
-all_results = {
-    label: compute_avg_cov_per_bin(path)
-    for label, path in file_paths.items()
-}
+all_results = compute_all(file_paths, compute_avg_cov_per_bin)
 
 all_bins = sorted(set(bin for res in all_results.values() for bin in res))
 
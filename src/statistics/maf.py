@@ -3,34 +3,49 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import subprocess
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 vcf_dir = "/home/huettt/Documents/nipt/NIPT-human-genetics/working/vcf_"
 output_dir = os.path.join(vcf_dir, "maf_analysis")
 os.makedirs(output_dir, exist_ok=True)
 chromosomes = [str(i) for i in range(1, 22)] + ["X"]
 
-maf_output_file = os.path.join(output_dir, "all_maf.txt")
+BINS = 1000
+AF_RANGE = (0.001, 0.5)
+CHUNK_SIZE = 1_000_000
 
-print("🔬 Đang tính MAF bằng bcftools...")
-with open(maf_output_file, "w") as outfile:
-    for chrom in chromosomes:
-        vcf_path = os.path.join(vcf_dir, f"chr{chrom}_variants.vcf.gz")
-        if not os.path.exists(vcf_path):
-            continue
-        cmd = f"bcftools query -f '%CHROM\\t%POS\\t%REF\\t%ALT\\t%AF\\n' {vcf_path}"
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        outfile.write(result.stdout)
 
-print("✅ Đã trích xuất tần suất alen (AF). Đang vẽ phân bố...")
+def af_histogram(chrom):
+    # Histogram of one chromosome's AF column, parsed from bcftools query in fixed-size chunks
+    # so memory stays flat however many variants the VCF holds
+    counts = np.zeros(BINS, dtype=np.int64)
+    vcf_path = os.path.join(vcf_dir, f"chr{chrom}_variants.vcf.gz")
+    if not os.path.exists(vcf_path):
+        return counts
+
+    process = subprocess.Popen(["bcftools", "query", "-f", "%AF\\n", vcf_path], stdout=subprocess.PIPE)
+    try:
+        chunks = pd.read_csv(process.stdout, header=None, names=["AF"], dtype=str, chunksize=CHUNK_SIZE)
+        for chunk in chunks:
+            af = pd.to_numeric(chunk["AF"], errors="coerce").dropna()
+            af = af[(af >= AF_RANGE[0]) & (af <= AF_RANGE[1])]  # Giữ MAF hợp lệ
+            counts += np.histogram(af, bins=BINS, range=AF_RANGE)[0]
+    except pd.errors.EmptyDataError:
+        pass
+
+    process.stdout.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"bcftools query failed on {vcf_path}")
+    return counts
 
-maf_df = pd.read_csv(maf_output_file, sep="\t", header=None,
-                     names=["CHROM", "POS", "REF", "ALT", "AF"])
 
-maf_df = maf_df[pd.to_numeric(maf_df["AF"], errors='coerce').notnull()]
-maf_df["AF"] = maf_df["AF"].astype(float)
-maf_df = maf_df[(maf_df["AF"] >= 0.001) & (maf_df["AF"] <= 0.5)]  # Giữ MAF hợp lệ
+print("🔬 Đang tính MAF bằng bcftools...")
+with ThreadPoolExecutor(max_workers=len(chromosomes)) as executor:
+    counts = np.sum(list(executor.map(af_histogram, chromosomes)), axis=0)
+
+print("✅ Đã trích xuất tần suất alen (AF). Đang vẽ phân bố...")
 
-counts, bin_edges = np.histogram(maf_df["AF"], bins=1000, range=(0.001, 0.5))
+bin_edges = np.histogram_bin_edges([], bins=BINS, range=AF_RANGE)
 bin_centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
 
 plt.figure(figsize=(10, 5))
@@ -1,26 +1,52 @@
 import os
-import glob
 import csv
-from collections import defaultdict
-from cyvcf2 import VCF
+import numpy as np
+from vcf_regions import aggregate_windows
 
 vcf_dir = "/home/huettt/Documents/nipt/NIPT-human-genetics/working/vcf_"
 
-stats = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: {
-    'Total_GT': 0,
-    'ALT_GT': 0,
-    'HET_GT': 0,
-    'HOM_ALT': 0
-})))
-
 chrs = ["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chr20", "chr21", "chr22", "chrX"]
 
-for chr_name in chrs:
-    file = os.path.join(vcf_dir, f"{chr_name}_variants.vcf.gz")
-    vcf = VCF(file)
 
-    for record in vcf:
-        af = dict(record.INFO).get('AF', None)
+METRICS = ['Total_GT', 'ALT_GT', 'HET_GT', 'HOM_ALT']
+MAF_BINS = 51
+BLOCK_SIZE = 1000
+
+
+def genotype_columns(record):
+    # First two alleles of every sample, parsed like helper/truth_store.allele_columns: the trailing
+    # phase column is dropped and haploid calls get a missing (-1) second allele
+    alleles = record.genotype.array()[:, :-1]
+    first = alleles[:, 0]
+    second = alleles[:, 1] if alleles.shape[1] > 1 else np.full(len(first), -1, dtype=alleles.dtype)
+    return first, second
+
+
+def block_counts(counts, maf_bins, firsts, seconds):
+    first, second = np.stack(firsts), np.stack(seconds)
+    first_valid, second_valid = first >= 0, second >= 0
+    both_valid = first_valid & second_valid
+
+    flags = np.stack([
+        first_valid | second_valid,
+        (first_valid & (first > 0)) | (second_valid & (second > 0)),
+        both_valid & (first != second),
+        both_valid & (first == second) & (first > 0),
+    ], axis=-1)
+
+    # counts: samples x MAF bins x METRICS
+    maf_bins = np.array(maf_bins)
+    for maf_bin in np.unique(maf_bins):
+        counts[:, maf_bin] += flags[maf_bins == maf_bin].sum(axis=0)
+
+
+def window_stats(vcf, chr_name, records):
+    # {"samples": [...], "counts": samples x MAF bins x METRICS array} of the records of one window
+    counts = np.zeros((len(vcf.samples), MAF_BINS, len(METRICS)), dtype=np.int64)
+    maf_bins, firsts, seconds = [], [], []
+
+    for record in records:
+        af = record.INFO.get('AF', None)
         if af is None or not (0 <= af <= 1):
             continue
 
@@ -28,39 +54,40 @@ for chr_name in chrs:
         if maf < 0.001:
             continue
 
-        maf_bin = int(maf * 100)  
-        for i, sample_gt in enumerate(record.genotypes):
-            sample_name = vcf.samples[i]
-
-            # sample_gt: [allele1, allele2, phased] OR [allele1, None, phased] OR [allele1]
-            alleles = [a for a in sample_gt[:2] if a is not None and a >= 0]
-            gt_set = set(alleles) if alleles else None
-
-            if gt_set is not None:
-                stats[chr_name][sample_name][maf_bin]['Total_GT'] += 1
-
-                if any(a > 0 for a in gt_set):
-                    stats[chr_name][sample_name][maf_bin]['ALT_GT'] += 1
-
-                if len(alleles) == 2:
-                    if alleles[0] != alleles[1]:
-                        stats[chr_name][sample_name][maf_bin]['HET_GT'] += 1
-                    elif alleles[0] > 0:
-                        stats[chr_name][sample_name][maf_bin]['HOM_ALT'] += 1
-
-with open(os.path.join(vcf_dir, "genotype_stats_per_chr.csv"), 'w', newline='') as csvfile:
-    writer = csv.writer(csvfile)
-    writer.writerow(['Chr', 'Sample', 'MAF', 'Total_GT', 'ALT_GT', 'HET_GT', 'HOM_ALT'])
-    for chr_name in chrs:
-        for sample in sorted(stats[chr_name]):
-            for maf_bin in sorted(stats[chr_name][sample].keys()):
-                s = stats[chr_name][sample][maf_bin]
-                writer.writerow([
-                    chr_name,
-                    sample,
-                    maf_bin,
-                    s['Total_GT'],
-                    s['ALT_GT'],
-                    s['HET_GT'],
-                    s['HOM_ALT']
-                ])
+        first, second = genotype_columns(record)
+        maf_bins.append(int(maf * 100))
+        firsts.append(first)
+        seconds.append(second)
+        if len(maf_bins) >= BLOCK_SIZE:
+            block_counts(counts, maf_bins, firsts, seconds)
+            maf_bins, firsts, seconds = [], [], []
+
+    if maf_bins:
+        block_counts(counts, maf_bins, firsts, seconds)
+    return {"samples": list(vcf.samples), "counts": counts}
+
+
+def merge_stats(total, partial):
+    total["counts"] += partial["counts"]
+    return total
+
+
+def main():
+    vcf_paths = {chr_name: os.path.join(vcf_dir, f"{chr_name}_variants.vcf.gz") for chr_name in chrs}
+    stats = aggregate_windows(vcf_paths, window_stats, merge_stats)
+
+    with open(os.path.join(vcf_dir, "genotype_stats_per_chr.csv"), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Chr', 'Sample', 'MAF', 'Total_GT', 'ALT_GT', 'HET_GT', 'HOM_ALT'])
+        for chr_name in chrs:
+            if chr_name not in stats:
+                continue
+            samples, counts = stats[chr_name]["samples"], stats[chr_name]["counts"]
+            # Only (sample, bin) pairs with at least one called genotype, as before
+            for i in sorted(range(len(samples)), key=lambda i: samples[i]):
+                for maf_bin in np.flatnonzero(counts[i, :, 0]):
+                    writer.writerow([chr_name, samples[i], maf_bin] + counts[i, maf_bin].tolist())
+
+
+if __name__ == "__main__":
+    main()
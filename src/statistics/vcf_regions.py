@@ -0,0 +1,64 @@
+import os
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from cyvcf2 import VCF
+
+WINDOW = 5_000_000
+WORKERS = os.cpu_count()
+IN_FLIGHT = 2
+
+
+def chromosome_windows(vcf_path, chromosome, window=WINDOW):
+    # (start, end) windows, 1-based and inclusive, covering `chromosome` by its header length
+    vcf = VCF(vcf_path, lazy=True)
+    length = dict(zip(vcf.seqnames, vcf.seqlens)).get(chromosome)
+    vcf.close()
+    if not length:
+        raise ValueError(f"{chromosome} has no contig length in the header of {vcf_path}")
+    return [(start, min(start + window - 1, length)) for start in range(1, length + 1, window)]
+
+
+def iter_window(vcf, chromosome, start, end):
+    # Records starting inside the window; records overlapping it from the left belong to the previous one
+    for record in vcf(f"{chromosome}:{start}-{end}"):
+        if record.POS >= start:
+            yield record
+
+
+def _run_window(work, vcf_path, chromosome, start, end):
+    vcf = VCF(vcf_path, lazy=True)
+    try:
+        return chromosome, work(vcf, chromosome, iter_window(vcf, chromosome, start, end))
+    finally:
+        vcf.close()
+
+
+def aggregate_windows(vcf_paths, work, merge, workers=WORKERS, window=WINDOW):
+    """
+    Run `work(vcf, chromosome, records)` over every tabix window of every {chromosome: vcf_path}
+    on a process pool and fold each window's partial result into its chromosome's total with
+    `merge(total, partial)`, in window order. Returns {chromosome: total}; only the partial
+    aggregates ever cross process boundaries, never records, and at most `workers * IN_FLIGHT`
+    windows are submitted or waiting to be merged at any time.
+    """
+    tasks = [(vcf_path, chromosome, start, end)
+        for chromosome, vcf_path in vcf_paths.items()
+        for start, end in chromosome_windows(vcf_path, chromosome, window)]
+
+    # A new window is submitted only as one is merged, so finished partials waiting behind a
+    # slow window never pile up
+    totals = {}
+    pending = deque()
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        for task in itertools.islice(tasks, workers * IN_FLIGHT):
+            pending.append(executor.submit(_run_window, work, *task))
+        while pending:
+            chromosome, partial = pending.popleft().result()
+            totals[chromosome] = merge(totals[chromosome], partial) if chromosome in totals else partial
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(executor.submit(_run_window, work, *task))
+    return totals
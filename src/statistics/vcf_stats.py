@@ -1,5 +1,7 @@
 import os
+import json
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import matplotlib.pyplot as plt
 
@@ -8,45 +10,42 @@ output_dir = os.path.join(vcf_dir, "stats")
 os.makedirs(output_dir, exist_ok=True)
 
 chromosomes = [str(i) for i in range(1, 23)] + ["X"]
-summary_data = []
 
-print("Bắt đầu thống kê toàn bộ thông số biến thể...")
+# Same thread budget as the pipeline (PARAMETERS["threads"]); each bcftools stats pass reads a full cohort VCF
+with open("/home/huettt/Documents/nipt/NIPT-human-genetics/working/conf/parameter.json") as f:
+    WORKERS = min(len(chromosomes), json.load(f)["threads"])
 
-def stats_all():
-    for chrom in chromosomes:
-        vcf_file = os.path.join(vcf_dir, f"chr{chrom}_variants.vcf.gz")
+# bcftools stats SN keys -> summary columns; the SNP and indel counts come from the same pass
+# as the total, so no filtered copy of the VCF is ever written
+SN_FIELDS = {
+    "number of records:": "TotalVariants",
+    "number of SNPs:": "SNPs",
+    "number of indels:": "InDels",
+}
 
-        # === 1. Tổng số biến thể (SNPs + InDels) ===
-        stats_file = os.path.join(output_dir, f"chr{chrom}.stats.txt")
-        subprocess.run(f"bcftools stats {vcf_file} > {stats_file}", shell=True, check=True)
+print("Bắt đầu thống kê toàn bộ thông số biến thể...")
 
-        total_variants = 0
-        with open(stats_file) as f:
-            for line in f:
-                if line.startswith("SN") and "number of records:" in line:
-                    total_variants = int(line.strip().split()[-1])
-                    break
+def chromosome_summary(chrom):
+    vcf_file = os.path.join(vcf_dir, f"chr{chrom}_variants.vcf.gz")
+    stats_file = os.path.join(output_dir, f"chr{chrom}.stats.txt")
+    with open(stats_file, "w") as out:
+        subprocess.run(["bcftools", "stats", vcf_file], stdout=out, check=True)
 
-        # === 2. Số SNPs ===
-        snps_file = os.path.join(output_dir, f"chr{chrom}.snps.vcf.gz")
-        subprocess.run(f"bcftools view -v snps {vcf_file} -Oz -o {snps_file}", shell=True)
-        subprocess.run(f"bcftools index {snps_file}", shell=True)
-        snps_stats = subprocess.check_output(f"bcftools index -n {snps_file}", shell=True)
-        num_snps = int(snps_stats.decode().strip())
+    summary = {"Chromosome": chrom, "TotalVariants": 0, "SNPs": 0, "InDels": 0}
+    with open(stats_file) as f:
+        for line in f:
+            if not line.startswith("SN"):
+                continue
+            # SN <id> <key> <value>
+            fields = line.rstrip("\n").split("\t")
+            if fields[2] in SN_FIELDS:
+                summary[SN_FIELDS[fields[2]]] = int(fields[3])
+    return summary
 
-        # === 3. Số InDels ===
-        indels_file = os.path.join(output_dir, f"chr{chrom}.indels.vcf.gz")
-        subprocess.run(f"bcftools view -v indels {vcf_file} -Oz -o {indels_file}", shell=True)
-        subprocess.run(f"bcftools index {indels_file}", shell=True)
-        indels_stats = subprocess.check_output(f"bcftools index -n {indels_file}", shell=True)
-        num_indels = int(indels_stats.decode().strip())
 
-        summary_data.append({
-            "Chromosome": chrom,
-            "TotalVariants": total_variants,
-            "SNPs": num_snps,
-            "InDels": num_indels
-        })
+def stats_all():
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        summary_data = list(executor.map(chromosome_summary, chromosomes))
 
     df = pd.DataFrame(summary_data)
     df["Chromosome"] = pd.Categorical(df["Chromosome"], categories=chromosomes, ordered=True)
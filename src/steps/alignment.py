@@ -1,11 +1,21 @@
-import os
+import os, math
 import subprocess
 import shutil
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from helper.config import TOOLS, PATHS, PARAMETERS
 from helper.path_define import samid, tmp_outdir, batch1_final_outdir, bamlist_dir
+from helper.path_define import rmdup_bam_path, bqsr_bam_path, cvg_bed_path, cvg_npz_path
 from helper.logger import setup_logger
+from helper.file_utils import load_reference_fai
+from helper.scheduler import Task, run_tasks, tool_cost
+from helper.cache import step_key, restore_outputs, store_outputs, discard_outputs
+from helper.coverage import summarise_coverage, BIN_SIZE, MAX_DEPTH, WORKERS as COVERAGE_WORKERS, WORKER_MEMORY
 
 REF = PATHS["ref"]
+REF_FAI = PATHS["ref_fai"]
+BWA_INDEX = [f"{REF}.{ext}" for ext in ("amb", "ann", "bwt", "pac", "sa")]
 GATK_BUNDLE_DIR = PATHS["gatk_bundle_dir"]
 BWA = TOOLS["bwa"]
 SAMTOOLS = TOOLS["samtools"]
@@ -14,189 +24,379 @@ JAVA = TOOLS["java"]
 BEDTOOLS = TOOLS["bedtools"]
 BGZIP = TOOLS["bgzip"]
 TABIX=TOOLS["tabix"]
+GATK_THREADS, GATK_MEMORY = tool_cost("gatk")
+BWA_THREADS, _ = tool_cost("bwa")
+# The bwa task's threads, split between the stages that run at once: the aligner, the samtools
+# stage reading its SAM (sort, or view when staged), and the single-threaded fixmate
+PIPE_THREADS = max(1, BWA_THREADS // 4)
+ALIGN_THREADS = max(1, BWA_THREADS - PIPE_THREADS - 1)
+SAMTOOLS_THREADS, _ = tool_cost("samtools")
+KNOWN_INDELS = [
+    os.path.join(GATK_BUNDLE_DIR, "Mills_and_1000G_gold_standard.indels.hg38.vcf.gz"),
+    os.path.join(GATK_BUNDLE_DIR, "Homo_sapiens_assembly38.known_indels.vcf.gz"),
+]
+DBSNP = os.path.join(GATK_BUNDLE_DIR, "Homo_sapiens_assembly38.dbsnp138.vcf.gz")
+ALN_OPTIONS = ["-e", "10", "-i", "5", "-q", "0"]
+MEM_OPTIONS = []
+ALIGNER = PARAMETERS["alignment"].get("aligner", "bwa_aln")
+STREAMING = PARAMETERS["alignment"].get("streaming", True)
+SORT_MEMORY = PARAMETERS["alignment"].get("sort_memory", "768M")
+REFINE = PARAMETERS["alignment"].get("refine", "full")
+SCATTER = PARAMETERS["alignment"].get("scatter") or GATK_THREADS
+REALIGN_MEMORY = PARAMETERS["alignment"].get("realign_memory", 4)
+# IndelRealigner JVMs that fit the gatk booking with at least REALIGN_MEMORY GB of heap each
+REALIGN_WORKERS = max(1, min(SCATTER, GATK_THREADS, GATK_MEMORY // REALIGN_MEMORY))
+# statistics/bedtools_stats*.py still read the bedGraph; keep it on until they read the .npz
+BEDGRAPH = PARAMETERS["alignment"].get("bedgraph", True)
 
 logger = setup_logger(os.path.join(PATHS["logs"], "alignment_pipeline.log"))
 
-
-def run_bwa_alignment(fq, outdir):
-    logger.info(f"Calculating {fq}. We'll save it in {outdir}")
-
-    sai_file = os.path.join(outdir, f"{samid(fq)}.sai")
+BAM_LIST_LOCK = threading.Lock()
+
+
+def run_piped(commands, log_file):
+    # Chain commands stdout -> stdin; every stderr goes to the log so no pipe is left undrained
+    processes = []
+    with open(log_file, "a") as log:
+        for i, command in enumerate(commands):
+            stdin = processes[-1].stdout if processes else None
+            stdout = subprocess.PIPE if i < len(commands) - 1 else subprocess.DEVNULL
+            processes.append(subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=log))
+            if stdin:
+                stdin.close()
+        codes = [process.wait() for process in processes]
+
+    failed = [os.path.basename(command[0]) for command, code in zip(commands, codes) if code != 0]
+    if failed:
+        raise RuntimeError(f"Pipeline failed in {failed}, see {log_file}")
+
+
+def read_group(fq):
+    return f"@RG\\tID:default\\tPL:COMPLETE\\tSM:{samid(fq)}"
+
+
+@contextmanager
+def bwa_aln_sam(fq, outdir, log_file):
+    # bwa aln writes its .sai into a FIFO read by samse, so the .sai never touches disk
+    sai_fifo = os.path.join(outdir, f"{samid(fq)}.sai.fifo")
+    if os.path.lexists(sai_fifo):
+        os.remove(sai_fifo)
+    os.mkfifo(sai_fifo)
+
+    with open(log_file, "a") as log:
+        aln_process = subprocess.Popen([BWA, "aln", *ALN_OPTIONS, "-t", f"{ALIGN_THREADS}",
+            "-f", sai_fifo, REF, fq
+        ], stdout=subprocess.DEVNULL, stderr=log)
+
+    try:
+        yield [BWA, "samse", "-r", read_group(fq), REF, sai_fifo, fq]
+    except Exception:
+        # aln blocks on the FIFO forever if samse died before opening it
+        aln_process.kill()
+        raise
+    finally:
+        aln_process.wait()
+        os.remove(sai_fifo)
+
+    if aln_process.returncode != 0:
+        raise RuntimeError(f"bwa aln failed for {fq}, see {log_file}")
+
+
+@contextmanager
+def bwa_mem_sam(fq, outdir, log_file):
+    yield [BWA, "mem", *MEM_OPTIONS, "-t", f"{ALIGN_THREADS}", "-R", read_group(fq), REF, fq]
+
+
+# Aligner backends: context managers yielding a command that writes SAM for `fq` to stdout
+ALIGNERS = {
+    "bwa_aln": bwa_aln_sam,
+    "bwa_mem": bwa_mem_sam,
+}
+ALIGNER_OPTIONS = {
+    "bwa_aln": ALN_OPTIONS,
+    "bwa_mem": MEM_OPTIONS,
+}
+
+
+def stream_alignment(fq, outdir, rmdup_bam, log_file, aligner):
+    # The aligner's SAM flows through fixmate, sort and markdup, so the indexed rmdup BAM is the only file written.
+    # sort emits nothing before its input ends, so markdup takes over the aligner's threads
+    with ALIGNERS[aligner](fq, outdir, log_file) as sam_command:
+        run_piped([
+            sam_command,
+            # Aligner output keeps read order, so single-end records are already grouped by name for fixmate
+            [SAMTOOLS, "fixmate", "-m", "-u", "-", "-"],
+            [SAMTOOLS, "sort", "-@", f"{PIPE_THREADS}", "-m", SORT_MEMORY, "-u",
+                "-T", os.path.join(outdir, f"{samid(fq)}.sort"), "-"],
+            [SAMTOOLS, "markdup", "-@", f"{ALIGN_THREADS}", "--write-index",
+                "-", f"{rmdup_bam}##idx##{rmdup_bam}.bai"],
+        ], log_file)
+
+
+def staged_alignment(fq, outdir, rmdup_bam, log_file, aligner):
     bam_file = os.path.join(outdir, f"{samid(fq)}.bam")
     sorted_bam = os.path.join(outdir, f"{samid(fq)}.sorted.bam")
-    rmdup_bam = os.path.join(outdir, f"{samid(fq)}.sorted.rmdup.bam")
-    finish_flag = os.path.join(outdir, f"{samid(fq)}.bwa_sort_rmdup.finish")
-
-    # Step 0: Verify the flag
-    if os.path.exists(finish_flag):
-        logger.info(f"BWA alignment for {fq} already exist. Skip alignment...")
-        return
-
-    # Step 1: BWA alignment
-    logger.info("\nRunning BWA alignment...")    
-    with open(sai_file, "w") as sai_out:
-        subprocess.run([BWA, "aln", "-e", "10", "-t", f"{PARAMETERS['threads']}", "-i", "5", "-q", "0", REF, fq
-        ], stdout=sai_out, check=True)
-
-    with open(bam_file, "wb") as bam_out:
-        bwa_process = subprocess.Popen([BWA, "samse", "-r",
-            f"@RG\\tID:default\\tPL:COMPLETE\\tSM:{samid(fq)}",
-            REF, sai_file, fq
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-        subprocess.run([SAMTOOLS, "view", "-h", "-Sb", "-@", f"{PARAMETERS['threads']}", "-"
-        ], stdin=bwa_process.stdout, stdout=bam_out, check=True)
-            
-        bwa_process.stdout.close()
-        bwa_process.wait() 
 
+    # Step 1: Alignment
+    logger.info(f"\nRunning {aligner} alignment...")
+    with ALIGNERS[aligner](fq, outdir, log_file) as sam_command:
+        run_piped([
+            sam_command,
+            [SAMTOOLS, "view", "-h", "-Sb", "-@", f"{PIPE_THREADS}", "-o", bam_file, "-"],
+        ], log_file)
     logger.info("** BWA done **")
 
     # Step 2: Sorting BAM
     logger.info("Sorting BAM...")
-    subprocess.run([SAMTOOLS, "sort", "-@", f"{PARAMETERS['threads']}", "-O", "bam", "-o", sorted_bam, bam_file], check=True)
+    subprocess.run([SAMTOOLS, "sort", "-@", f"{BWA_THREADS}", "-O", "bam", "-o", sorted_bam, bam_file], check=True)
     logger.info("** BAM sorted done **")
 
     # Step 3: Removing duplicates
     logger.info("Removing duplicates...")
-    subprocess.run([SAMTOOLS, "markdup", "-@", f"{PARAMETERS['threads']}", sorted_bam, rmdup_bam], check=True)
+    subprocess.run([SAMTOOLS, "markdup", "-@", f"{BWA_THREADS}", sorted_bam, rmdup_bam], check=True)
     logger.info("** rmdup done **")
 
     # Step 4: Indexing BAM
     logger.info("Indexing BAM...")
-    subprocess.run([SAMTOOLS, "index", "-@", f"{PARAMETERS['threads']}", rmdup_bam], check=True)
+    subprocess.run([SAMTOOLS, "index", "-@", f"{BWA_THREADS}", rmdup_bam], check=True)
     logger.info("** index done **")
 
-    # Step 5: Create finish flag
-    with open(finish_flag, "w") as finish_file:
-        finish_file.write("BWA alignment completed successfully.")
-    logger.info(f"BWA alignment for {samid} completed successfully.")
-
 
-def run_bwa_realign(sample_id, outdir):
-    logger.info(f"\nStarting realign {samid} pipeline...")
+def run_bwa_alignment(fq, outdir, aligner=ALIGNER, use_cache=True):
+    if aligner not in ALIGNERS:
+        raise ValueError(f"Unknown aligner {aligner}, expected one of {sorted(ALIGNERS)}")
+    logger.info(f"Calculating {fq} with {aligner}. We'll save it in {outdir}")
 
-    bam_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.bam")
-    intervals_file = os.path.join(outdir, f"{sample_id}.indel_target_intervals.list")
-    realigned_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.bam")
-    finish_flag = os.path.join(outdir, f"{sample_id}.realigner.finish")
+    rmdup_bam = rmdup_bam_path(samid(fq), outdir)
+    log_file = os.path.join(outdir, f"{samid(fq)}.bwa.log")
+    outputs = [rmdup_bam, f"{rmdup_bam}.bai"]
+    key = step_key("bwa_sort_rmdup", inputs=[fq, REF, *BWA_INDEX], tools=["bwa", "samtools"], params={
+        "aligner": aligner, "options": ALIGNER_OPTIONS[aligner], "read_group": samid(fq), "streaming": STREAMING
+    })
 
-    # Step 0: Verify the flag
-    if os.path.exists(finish_flag):
-        logger.info(f"Realigner for {sample_id} already exist. Skip realign...")
+    # Step 0: Reuse a cached result for identical inputs, unless the caller needs a fresh run
+    if not use_cache:
+        discard_outputs(outputs)
+    elif restore_outputs(key, outputs):
+        logger.info(f"BWA alignment for {fq} already exist. Skip alignment...")
         return
 
-    # Step 1: RealignerTargetCreator
-    logger.info("Running RealignerTargetCreator...")
-    subprocess.run([JAVA, "-Xmx15g", "-jar", GATK,
-        "-T", "RealignerTargetCreator",
-        "-R", REF, "-I", bam_file,
-        "-known", os.path.join(GATK_BUNDLE_DIR, "Mills_and_1000G_gold_standard.indels.hg38.vcf.gz"),
-        "-known", os.path.join(GATK_BUNDLE_DIR, "Homo_sapiens_assembly38.known_indels.vcf.gz"),
-        "-o", intervals_file
-    ], check=True)
-    logger.info("** RealignerTargetCreator done **")
+    # Step 1: Align, sort, mark duplicates and index
+    open(log_file, "w").close()
+    if STREAMING:
+        logger.info(f"\nRunning streaming {aligner} | fixmate | sort | markdup...")
+        stream_alignment(fq, outdir, rmdup_bam, log_file, aligner)
+        logger.info("** BWA, sort and rmdup done **")
+    else:
+        staged_alignment(fq, outdir, rmdup_bam, log_file, aligner)
 
-    # Step 2: IndelRealigner
-    logger.info("Running IndelRealigner...")
-    subprocess.run([JAVA, "-Xmx15g", "-jar", GATK,
-        "-T", "IndelRealigner",
-        "-R", REF, "-I", bam_file,
-        "-known", os.path.join(GATK_BUNDLE_DIR, "Mills_and_1000G_gold_standard.indels.hg38.vcf.gz"),
-        "-known", os.path.join(GATK_BUNDLE_DIR, "Homo_sapiens_assembly38.known_indels.vcf.gz"),
-        "--targetIntervals", intervals_file,
-        "-o", realigned_bam
-    ], check=True)
-    logger.info("** IndelRealigner done **")
+    # Step 2: Cache the result
+    if use_cache:
+        store_outputs(key, outputs)
+    logger.info(f"BWA alignment for {samid(fq)} completed successfully.")
 
-    # Create finish flag for IndelRealigner
-    with open(finish_flag, "w") as flag:
-        flag.write("Realign completed successfully.")
-    logger.info(f"Realign pipeline for {samid} completed successfully.")
 
+def gatk_command(tool, memory, *args):
+    return [JAVA, f"-Xmx{memory}g", "-jar", GATK, "-T", tool, "-R", REF, *args]
 
-def run_bqsr(sample_id, outdir):
-    realigned_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.bam")
-    recal_table = os.path.join(outdir, f"{sample_id}.recal_data.table")
-    bqsr_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bam")
-    bsqr_flag = os.path.join(outdir, f"{sample_id}.bsqr.finish")
 
-    # Step 0: Verify the flag
-    if os.path.exists(bsqr_flag):
-        logger.info(f"BSQR result for {samid} already exist. Skip bsqr...")
-        return
+def known_indels_args(flag):
+    return [arg for known in KNOWN_INDELS for arg in (flag, known)]
 
-    # Step 1: Index the realigned BAM
-    logger.info("Indexing realigned BAM...")
-    subprocess.run([SAMTOOLS, "index", "-@", f"{PARAMETERS['threads']}", realigned_bam], check=True)
-    logger.info("** Index done **")
 
-    # Step 2: BaseRecalibrator
+def base_recalibrator(bam_file, recal_table, threads=GATK_THREADS, memory=GATK_MEMORY):
     logger.info("Running BaseRecalibrator...")
-    subprocess.run([JAVA, "-jar", GATK,
-        "-T", "BaseRecalibrator",
-        "-nct", "8",
-        "-R", REF,
-        "-I", realigned_bam,
-        "--knownSites", os.path.join(GATK_BUNDLE_DIR, "Homo_sapiens_assembly38.dbsnp138.vcf.gz"),
-        "--knownSites", os.path.join(GATK_BUNDLE_DIR, "Mills_and_1000G_gold_standard.indels.hg38.vcf.gz"),
-        "--knownSites", os.path.join(GATK_BUNDLE_DIR, "Homo_sapiens_assembly38.known_indels.vcf.gz"),
+    subprocess.run(gatk_command("BaseRecalibrator", memory,
+        "-nct", f"{threads}",
+        "-I", bam_file,
+        "--knownSites", DBSNP,
+        *known_indels_args("--knownSites"),
         "-o", recal_table
-    ], check=True)
+    ), check=True)
     logger.info("** BaseRecalibrator done **")
 
-    # Step 3: PrintReads
+
+def target_creator(bam_file, intervals_file, threads=GATK_THREADS, memory=GATK_MEMORY):
+    logger.info("Running RealignerTargetCreator...")
+    subprocess.run(gatk_command("RealignerTargetCreator", memory,
+        "-nt", f"{threads}",
+        "-I", bam_file,
+        *known_indels_args("-known"),
+        "-o", intervals_file
+    ), check=True)
+    logger.info("** RealignerTargetCreator done **")
+
+
+def scatter_intervals(sample_id, outdir):
+    # Consecutive reference contigs grouped into SCATTER shards of similar length, plus one
+    # shard for unmapped reads, so concatenating the shard outputs in order stays sorted
+    contigs = load_reference_fai(REF_FAI)
+    total = sum(end for _, _, end in contigs)
+    groups, group, size = [], [], 0
+    for contig, _, end in contigs:
+        group.append(contig)
+        size += end
+        if size >= total * (len(groups) + 1) / SCATTER:
+            groups.append(group)
+            group = []
+    if group:
+        groups.append(group)
+
+    shards = []
+    for i, group in enumerate(groups):
+        shard_file = os.path.join(outdir, f"{sample_id}.scatter.{i:02d}.list")
+        with open(shard_file, "w") as f:
+            f.write("\n".join(group) + "\n")
+        shards.append(shard_file)
+    return shards + ["unmapped"]
+
+
+def indel_realign_shard(bam_file, intervals_file, recal_table, shard, output_bam, memory):
+    # -BQSR recalibrates reads on the fly, so the realigned shard is already the BQSR output
+    subprocess.run(gatk_command("IndelRealigner", memory,
+        "-I", bam_file,
+        "-L", shard,
+        "-BQSR", recal_table,
+        *known_indels_args("-known"),
+        "--targetIntervals", intervals_file,
+        "-o", output_bam
+    ), check=True)
+    return output_bam
+
+
+def refine_none(sample_id, outdir):
+    bam_file = rmdup_bam_path(sample_id, outdir)
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
+    for src_file, dst_file in [(bam_file, bqsr_bam), (f"{bam_file}.bai", f"{bqsr_bam}.bai")]:
+        if os.path.lexists(dst_file):
+            os.remove(dst_file)
+        os.link(src_file, dst_file)
+
+
+def refine_fast(sample_id, outdir):
+    bam_file = rmdup_bam_path(sample_id, outdir)
+    recal_table = os.path.join(outdir, f"{sample_id}.recal_data.table")
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
+
+    # Step 1: BaseRecalibrator
+    base_recalibrator(bam_file, recal_table)
+
+    # Step 2: PrintReads
     logger.info("Running PrintReads...")
-    subprocess.run([JAVA, "-jar", GATK,
-        "-T", "PrintReads",
-        "-nct", "8",
-        "-R", REF,
+    subprocess.run(gatk_command("PrintReads", GATK_MEMORY,
+        "-nct", f"{GATK_THREADS}",
         "--BQSR", recal_table,
-        "-I", realigned_bam,
+        "-I", bam_file,
         "-o", bqsr_bam
-    ], check=True)
+    ), check=True)
     logger.info("** PrintReads done **")
-    
-    # Step 4: Index the BQSR BAM
-    logger.info("Indexing BQSR BAM...")
-    subprocess.run([SAMTOOLS, "index", "-@", f"{PARAMETERS['threads']}", bqsr_bam], check=True)
-    logger.info("** BAM index done **")
 
-    # Create finish flag for BSQR
-    with open(bsqr_flag, "w") as flag:
-        flag.write("BSQR completed successfully.")
-    logger.info("BQSR pipeline completed successfully.")
+    # Step 3: Index the BQSR BAM
+    subprocess.run([SAMTOOLS, "index", "-@", f"{GATK_THREADS}", bqsr_bam], check=True)
+
+
+def refine_full(sample_id, outdir):
+    bam_file = rmdup_bam_path(sample_id, outdir)
+    intervals_file = os.path.join(outdir, f"{sample_id}.indel_target_intervals.list")
+    recal_table = os.path.join(outdir, f"{sample_id}.recal_data.table")
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
+
+    # Step 1: RealignerTargetCreator and BaseRecalibrator both read the rmdup BAM, so they run side by side
+    half_threads, half_memory = max(1, GATK_THREADS // 2), max(1, GATK_MEMORY // 2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(target_creator, bam_file, intervals_file, half_threads, half_memory),
+            executor.submit(base_recalibrator, bam_file, recal_table, half_threads, half_memory),
+        ]
+        for future in futures:
+            future.result()
+
+    # Step 2: IndelRealigner scattered over contig groups, recalibrating on the fly
+    logger.info(f"Running IndelRealigner over {SCATTER} shards, {REALIGN_WORKERS} at a time...")
+    shards = scatter_intervals(sample_id, outdir)
+    shard_bams = [os.path.join(outdir, f"{sample_id}.realign.{i:02d}.bam") for i in range(len(shards))]
+    shard_memory = max(1, GATK_MEMORY // REALIGN_WORKERS)
+    with ThreadPoolExecutor(max_workers=REALIGN_WORKERS) as executor:
+        list(executor.map(indel_realign_shard,
+            [bam_file] * len(shards), [intervals_file] * len(shards), [recal_table] * len(shards),
+            shards, shard_bams, [shard_memory] * len(shards)))
+    logger.info("** IndelRealigner done **")
+
+    # Step 3: Concatenate the shards in reference order and index
+    subprocess.run([SAMTOOLS, "cat", "-o", bqsr_bam, *shard_bams], check=True)
+    subprocess.run([SAMTOOLS, "index", "-@", f"{GATK_THREADS}", bqsr_bam], check=True)
+
+    for shard_bam in shard_bams:
+        for path in (shard_bam, shard_bam.replace(".bam", ".bai")):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# Post-alignment refinement modes: rmdup BAM -> BQSR BAM (the final name is kept for every mode)
+REFINE_MODES = {
+    "none": refine_none,
+    "fast": refine_fast,
+    "full": refine_full,
+}
+
+
+def run_refine(sample_id, outdir, mode=REFINE, use_cache=True):
+    if mode not in REFINE_MODES:
+        raise ValueError(f"Unknown refine mode {mode}, expected one of {sorted(REFINE_MODES)}")
+
+    bam_file = rmdup_bam_path(sample_id, outdir)
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
+    outputs = [bqsr_bam, f"{bqsr_bam}.bai"]
+    key = step_key("refine", inputs=[bam_file, REF, DBSNP, *KNOWN_INDELS], tools=["java", "gatk", "samtools"],
+        params={"mode": mode, "scatter": SCATTER if mode == "full" else None})
+
+    # Step 0: Reuse a cached result for identical inputs, unless the caller needs a fresh run
+    if not use_cache:
+        discard_outputs(outputs)
+    elif restore_outputs(key, outputs):
+        logger.info(f"Refined BAM for {sample_id} already exist. Skip refine...")
+        return
+
+    # Step 1: Refine in the configured mode
+    logger.info(f"\nStarting {mode} refinement for {sample_id}...")
+    REFINE_MODES[mode](sample_id, outdir)
+
+    # Step 2: Cache the result
+    if use_cache:
+        store_outputs(key, outputs)
+    logger.info(f"Refinement for {sample_id} completed successfully.")
 
 
 def run_bam_stats(sample_id, outdir):
-    bqsr_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bam")
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
     bam_stats_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bamstats")
-    bam_stats_flag = os.path.join(outdir, f"{sample_id}.bamstats.finish")
+    outputs = [bam_stats_file]
+    key = step_key("bamstats", inputs=[bqsr_bam], tools=["samtools"])
 
-    # Verify the flag
-    if os.path.exists(bam_stats_flag):
+    # Reuse a cached result for identical inputs
+    if restore_outputs(key, outputs):
         logger.info(f"Stats result for {samid} already exist. Skip stats...")
         return
 
     # Run Samtools stats
     logger.info(f"Running Samtools stats for {samid}...")
     with open(bam_stats_file, "w") as stats_out:
-        subprocess.run([SAMTOOLS, "stats", "-@", f"{PARAMETERS['threads']}", bqsr_bam], stdout=stats_out, check=True)
+        subprocess.run([SAMTOOLS, "stats", "-@", f"{SAMTOOLS_THREADS}", bqsr_bam], stdout=stats_out, check=True)
     logger.info("** bamstats done **")
 
-    # Create finish flag
-    with open(bam_stats_flag, "w") as flag:
-        flag.write("bamstats completed successfully.")
+    # Cache the result
+    store_outputs(key, outputs)
     logger.info(f"Done statistics for {sample_id}.")
 
 
 def run_bedtools(sample_id, outdir):
-    bqsr_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bam")
-    cvg_bed_gz = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.cvg.bed.gz")
-    finish_flag = os.path.join(outdir, f"{sample_id}.sorted_rmdup_realign_BQSR_cvg_bed.finish")
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
+    cvg_bed_gz = cvg_bed_path(sample_id, outdir)
+    outputs = [cvg_bed_gz, f"{cvg_bed_gz}.tbi"]
+    key = step_key("bedtools_genomecov", inputs=[bqsr_bam], tools=["bedtools", "bgzip", "tabix"])
 
-    # Step 0: Verify the flag
-    if os.path.exists(finish_flag):
+    # Step 0: Reuse a cached result for identical inputs
+    if restore_outputs(key, outputs):
         logger.info(f"Bedtools result for {samid} already exist. Skip bedtools...")
         return
 
@@ -214,99 +414,149 @@ def run_bedtools(sample_id, outdir):
     logger.info("Indexing the compressed BED file with Tabix...")
     subprocess.run([TABIX, "-p", "bed", cvg_bed_gz], check=True)
 
-    # Create finish flag
-    with open(finish_flag, "w") as flag:
-        flag.write("Bedtools pipeline completed successfully.")
+    # Cache the result
+    store_outputs(key, outputs)
     logger.info("Bedtools pipeline completed successfully.")
 
 
-def move_final_output(fq, tmp_dir, final_dir):
-    bam_list_file = bamlist_dir(fq)
+def run_coverage_summary(sample_id, outdir):
+    bqsr_bam = bqsr_bam_path(sample_id, outdir)
+    cvg_npz = cvg_npz_path(sample_id, outdir)
+    outputs = [cvg_npz]
+    key = step_key("coverage_summary", inputs=[bqsr_bam], params={"bin_size": BIN_SIZE, "max_depth": MAX_DEPTH})
+
+    # Reuse a cached result for identical inputs
+    if restore_outputs(key, outputs):
+        logger.info(f"Coverage summary for {sample_id} already exist. Skip coverage...")
+        return
+
+    # Per-contig, per-bin and histogram summaries straight from the BAM
+    logger.info(f"Summarising coverage for {sample_id}...")
+    summarise_coverage(bqsr_bam, cvg_npz)
+    logger.info("** sorted.rmdup.realign.BQSR.cvg.npz done **")
+
+    # Cache the result
+    store_outputs(key, outputs)
+
+
+def read_bam_list(bam_list_file):
+    if not os.path.exists(bam_list_file):
+        return []
+    with open(bam_list_file) as bam_list:
+        return [line.strip() for line in bam_list if line.strip()]
+
 
-    # Step 1: Move files to the final output directory, generate bam.list 
+def write_bam_list(bam_list_file, bams, replace=False):
+    # Readers only ever see a complete bam.list: rewrite it under the lock and swap it in
+    with BAM_LIST_LOCK:
+        entries = [] if replace else read_bam_list(bam_list_file)
+        entries += [bam for bam in bams if bam not in entries]
+        tmp_file = f"{bam_list_file}.tmp"
+        with open(tmp_file, "w") as bam_list:
+            bam_list.writelines(f"{bam}\n" for bam in entries)
+        os.replace(tmp_file, bam_list_file)
+
+
+def final_bam_path(fq, final_dir):
+    return os.path.join(final_dir, os.path.basename(bqsr_bam_path(samid(fq), final_dir)))
+
+
+def move_final_output(fq, tmp_dir, final_dir, bam_list_file=None):
+    # Step 1: Move files to the final output directory
     logger.info("Moving final files to the output directory...")
-    for file_suffix in [".bam", ".bam.bai", ".cvg.bed.gz", ".cvg.bed.gz.tbi"]:
+    for file_suffix in [".bam", ".bam.bai", ".cvg.npz", ".cvg.bed.gz", ".cvg.bed.gz.tbi"]:
         src_file = os.path.join(tmp_dir, f"{samid(fq)}.sorted.rmdup.realign.BQSR{file_suffix}")
         dst_file = os.path.join(final_dir, os.path.basename(src_file))
         if os.path.exists(src_file):
             os.rename(src_file, dst_file)
-            if file_suffix == ".bam":
-                with open(bam_list_file, "a") as bam_list:
-                    bam_list.write(f"{dst_file}\n")
 
-    # Step 2: Remove the temporary output directory
+    # Step 2: Register the BAM in bam.list
+    if bam_list_file:
+        write_bam_list(bam_list_file, [final_bam_path(fq, final_dir)])
+
+    # Step 3: Remove the temporary output directory
     # logger.info("Removing temporary output directory...")
     # shutil.rmtree(tmp_dir)
     # logger.info(f"Temporary directory {tmp_dir} deleted.")
 
 
-def run_alignment_pipeline(fq):
-    os.makedirs(tmp_outdir(fq), exist_ok=True)
-    os.makedirs(batch1_final_outdir(fq), exist_ok=True)
-    finish_flag = os.path.join(batch1_final_outdir(fq), "alignment.finish")
+def alignment_tasks(fq, tmp_dir, final_dir, bam_list_file=None, finish=move_final_output):
+    sample_id = samid(fq)
 
-    # Step 0: Verify the flag
-    if os.path.exists(finish_flag):
-        logger.info(f"Alignment result for {samid(fq)} already exist. Skip alignment pipeline...")
-        return
+    # Every step restores its outputs from the step cache when its inputs are unchanged
+    tasks = [
+        # Step 1: Run BWA to align and remove duplicates
+        Task(f"{sample_id}.bwa", run_bwa_alignment, (fq, tmp_dir),
+            inputs=[fq, REF], outputs=[rmdup_bam_path(sample_id, tmp_dir)], tool="bwa"),
 
-    # Step 1: Run BWA to align and remove duplicates
-    run_bwa_alignment(fq, tmp_outdir(fq))
+        # Step 2: Realignment and base quality recalibration, in the configured refine mode
+        Task(f"{sample_id}.refine", run_refine, (sample_id, tmp_dir), deps=[f"{sample_id}.bwa"],
+            outputs=[bqsr_bam_path(sample_id, tmp_dir)], tool="gatk" if REFINE != "none" else None),
 
-    # Step 2: Realignment
-    run_bwa_realign(samid(fq), tmp_outdir(fq))
+        # Step 3: Generate BAM and coverage statistics
+        Task(f"{sample_id}.bamstats", run_bam_stats, (sample_id, tmp_dir), deps=[f"{sample_id}.refine"], tool="samtools"),
 
-    # Step 3: Recalibrate Base Quality Scores (BQSR)
-    run_bqsr(samid(fq), tmp_outdir(fq))
+        # Step 4: Coverage summary
+        Task(f"{sample_id}.coverage", run_coverage_summary, (sample_id, tmp_dir), deps=[f"{sample_id}.refine"],
+            outputs=[cvg_npz_path(sample_id, tmp_dir)],
+            threads=COVERAGE_WORKERS, memory=math.ceil(COVERAGE_WORKERS * WORKER_MEMORY)),
+    ]
 
-    # Step 4: Generate BAM and coverage statistics
-    run_bam_stats(samid(fq), tmp_outdir(fq))
-
-    # Step 5: Bedtools
-    run_bedtools(samid(fq), tmp_outdir(fq))
+    # Step 5: Optional full bedGraph, for tools that still need per-base coverage
+    if BEDGRAPH:
+        tasks.append(Task(f"{sample_id}.bedtools", run_bedtools, (sample_id, tmp_dir), deps=[f"{sample_id}.refine"],
+            outputs=[cvg_bed_path(sample_id, tmp_dir)], tool="bedtools"))
 
     # Step 6: Move final result file to batch1_final_files
-    move_final_output(fq, tmp_outdir(fq), batch1_final_outdir(fq))
+    tasks.append(Task(f"{sample_id}.alignment", finish, (fq, tmp_dir, final_dir, bam_list_file),
+        deps=[task.name for task in tasks[2:]],
+        outputs=[final_bam_path(fq, final_dir)]))
+    return tasks
+
+
+def run_alignment_pipeline(fq):
+    os.makedirs(tmp_outdir(fq), exist_ok=True)
+    os.makedirs(batch1_final_outdir(fq), exist_ok=True)
 
-    # Create finish flag
-    with open(finish_flag, "w") as flag:
-        flag.write("Alignment pipeline completed successfully.")
+    run_tasks(alignment_tasks(fq, tmp_outdir(fq), batch1_final_outdir(fq), bamlist_dir(fq)))
     logger.info(f"Done alignment for {samid(fq)}")
 
-def run_multiple_alignment(fqlist):
-    os.makedirs(tmp_outdir(fqlist), exist_ok=True)
-    os.makedirs(batch1_final_outdir(fqlist), exist_ok=True)
 
-    with open(fqlist, 'r') as file:
-        for line in file:
-            if line.strip():
-                fq = line.split()[0]
-                finish_flag = os.path.join(batch1_final_outdir(fqlist), f"{samid(fq)}_alignment.finish")
+def read_fastq_list(fqlist):
+    with open(fqlist) as file:
+        return [line.split()[0] for line in file if line.strip()]
 
-                # Step 0: Verify the flag
-                if os.path.exists(finish_flag):
-                    logger.info(f"Alignment result for {samid(fq)} already exist. Skip alignment pipeline...")
-                    continue
 
-                # Step 1: Run BWA to align and remove duplicates
-                run_bwa_alignment(fq, tmp_outdir(fqlist))
+def multiple_alignment_tasks(fqlist):
+    """
+    Alignment tasks for every sample of `fqlist`, all sharing the scheduler budget, and a
+    final `alignment` task that writes bam.list once every sample is done, in list order.
+    """
+    tmp_dir = tmp_outdir(fqlist)
+    final_dir = batch1_final_outdir(fqlist)
+    os.makedirs(tmp_dir, exist_ok=True)
+    os.makedirs(final_dir, exist_ok=True)
 
-                # Step 2: Realignment
-                run_bwa_realign(samid(fq), tmp_outdir(fqlist))
+    fqs = read_fastq_list(fqlist)
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
 
-                # Step 3: Recalibrate Base Quality Scores (BQSR)
-                run_bqsr(samid(fq), tmp_outdir(fqlist))
+    def finish_sample(fq, tmp_dir, final_dir, bam_list_file):
+        move_final_output(fq, tmp_dir, final_dir, bam_list_file)
+        with progress_lock:
+            progress["done"] += 1
+            logger.info(f"Done alignment for {samid(fq)} ({progress['done']}/{len(fqs)} samples)")
 
-                # Step 4: Generate BAM and coverage statistics
-                run_bam_stats(samid(fq), tmp_outdir(fqlist))
+    tasks = []
+    for fq in fqs:
+        tasks += alignment_tasks(fq, tmp_dir, final_dir, finish=finish_sample)
 
-                # Step 5: Bedtools
-                run_bedtools(samid(fq), tmp_outdir(fqlist))
+    final_bams = [final_bam_path(fq, final_dir) for fq in fqs]
+    tasks.append(Task("alignment", write_bam_list, (bamlist_dir(fqlist), final_bams, True),
+        deps=[f"{samid(fq)}.alignment" for fq in fqs], outputs=[bamlist_dir(fqlist)]))
+    return tasks
 
-                # Step 6: Move final result file to batch1_final_files
-                move_final_output(fq, tmp_outdir(fq), batch1_final_outdir(fqlist))
 
-                # Create finish flag
-                with open(finish_flag, "w") as flag:
-                    flag.write("Alignment pipeline completed successfully.")
-                logger.info(f"Done alignment for {samid(fq)}")
+def run_multiple_alignment(fqlist):
+    run_tasks(multiple_alignment_tasks(fqlist))
+    logger.info(f"Done alignment for every sample in {fqlist}")
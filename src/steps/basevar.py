@@ -1,11 +1,12 @@
 import subprocess
-import os
+import os, glob
 import shutil
 from helper.config import TOOLS, PARAMETERS, PATHS
 from helper.path_define import basevar_outdir, bamlist_dir, basevar_vcf, samid
 from helper.logger import setup_logger
-from concurrent.futures import ThreadPoolExecutor
-from helper.file_utils import create_vcf_list, merge_vcf_list
+from helper.file_utils import merge_vcf_list, load_reference_fai
+from helper.scheduler import Task, run_tasks
+from helper.cache import step_key, list_entries, restore_outputs, store_outputs
 
 logger = setup_logger(os.path.join(PATHS["logs"], "basevar_pipeline.log"))
 
@@ -15,58 +16,69 @@ REF_FAI = PATHS["ref_fai"]
 BCFTOOLS = TOOLS["bcftools"]
 TABIX = TOOLS["tabix"]
 DELTA = PARAMETERS["basevar"]["delta"]
+MIN_AF = PARAMETERS["maf"]
+MIN_DELTA = PARAMETERS["basevar"].get("min_delta", 1000000)
+RETRIES = PARAMETERS["basevar"].get("retries", 2)
 
-def load_reference_fai(in_fai, chroms=None):
-    ref = []
-    with open(in_fai) as fh:
-        for r in fh:
-            col = r.strip().split()
-            if chroms is not None and len(chroms):
-                if col[0] in chroms:
-                    ref.append([col[0], 1, int(col[1])])
-            else:
-                ref.append([col[0], 1, int(col[1])])
-    return ref
-
-
-def run_basevar_step(fq, chromosome):
-    ref_fai = load_reference_fai(REF_FAI, [chromosome])
-    bamlist_path = bamlist_dir(fq)
+
+def region_size(chromosome):
+    # Even shards of at most DELTA (and at least MIN_DELTA) over the chromosome's length; depends
+    # only on DELTA, MIN_DELTA and the length, so the cache key survives changes to the thread budget
+    length = sum(reg_end - reg_start + 1 for _, reg_start, reg_end in load_reference_fai(REF_FAI, [chromosome]))
+    shards = max(1, -(-length // DELTA))
+    return max(MIN_DELTA, -(-length // shards))
+
+
+def split_regions(chromosome):
+    size = region_size(chromosome)
+    regions = []
+    for chr_id, reg_start, reg_end in load_reference_fai(REF_FAI, [chromosome]):
+        for i in range(reg_start - 1, reg_end, size):
+            regions.append((chr_id, i + 1, min(i + size, reg_end)))
+    return regions
+
+
+def run_basevar_region(fq, chr_id, start, end):
     outdir = basevar_outdir(fq)
+    region = f"{chr_id}:{start}-{end}"
+    outfile_prefix = f"{chr_id}_{start}_{end}"
+    log_file = f"{outdir}/{outfile_prefix}.log"
+
+    print(f"Starting BaseVar for {fq} region {region}")
+    with open(log_file, "w") as log:
+        subprocess.run([TOOLS['basevar'], "basetype",
+            "-R", REF,
+            "-L", bamlist_dir(fq),
+            "-r", region,
+            f"--min-af={MIN_AF}",
+            "--output-vcf", f"{outdir}/{outfile_prefix}.vcf.gz",
+            "--output-cvg", f"{outdir}/{outfile_prefix}.cvg.tsv.gz",
+            "--smart-rerun"
+        ], stdout=log, stderr=subprocess.STDOUT, check=True)
+    print(f"Done BaseVar for region {region}")
+    return f"{outdir}/{outfile_prefix}.vcf.gz"
+
+
+def run_basevar_shard(fq, chromosome, start, end):
+    # The prepare task restored the merged VCF from the cache, so the shard has nothing to do
+    if os.path.exists(basevar_vcf(fq, chromosome)):
+        return
 
-    print(f"Run basevar step for {fq} {chromosome} with ref_fai {ref_fai} and delta {DELTA}")
-
-    for chr_id, reg_start, reg_end in ref_fai:
-        for i in range(reg_start - 1, reg_end, DELTA):
-            start = i + 1
-            end = min(i + DELTA, reg_end)
-            region = f"{chr_id}:{start}-{end}"
-            outfile_prefix = f"{chr_id}_{start}_{end}"
-            log_file = f"{outdir}/{outfile_prefix}.log"
-
-            print(f"Starting BaseVar for {fq} region {region}")
-
-            try:
-                with open(log_file, "w") as log:
-                    subprocess.run([TOOLS['basevar'], "basetype",
-                        "-R", REF,
-                        "-L", bamlist_path,
-                        "-r", region,
-                        "--min-af=0.001",
-                        "--output-vcf", f"{outdir}/{outfile_prefix}.vcf.gz",
-                        "--output-cvg", f"{outdir}/{outfile_prefix}.cvg.tsv.gz",
-                        "--smart-rerun"
-                    ], stdout=log, stderr=subprocess.STDOUT, check=True)
-                    print(f"Done BaseVar for region {region}")
-
-            except Exception as e:
-                logger.error(f"Unexpected error occurred for region {region}: {e}")
-                continue    
-
-
-def merge_vcf_files(fq, chromosome):
+    # Retry a failed shard up to RETRIES times before failing its task
+    for attempt in range(1, RETRIES + 2):
+        try:
+            return run_basevar_region(fq, chromosome, start, end)
+        except Exception as e:
+            logger.error(f"BaseVar failed for region {chromosome}:{start}-{end} (attempt {attempt}): {e}")
+            if attempt > RETRIES:
+                raise
+
+
+def merge_vcf_files(fq, chromosome, region_vcfs):
     print(f"Creating vcf_list for {fq} {chromosome}")
-    vcf_list = create_vcf_list(basevar_outdir(fq), f"{chromosome}")
+    vcf_list = os.path.join(basevar_outdir(fq), f"{chromosome}.vcf.list")
+    with open(vcf_list, "w") as f:
+        f.writelines(f"{vcf}\n" for vcf in region_vcfs)
     merged_vcf = basevar_vcf(fq, chromosome)
 
     print(f"Merging vcf_list for {fq} {chromosome}")
@@ -76,37 +88,78 @@ def merge_vcf_files(fq, chromosome):
     subprocess.run([TABIX, "-f", merged_vcf], check=True)
 
 
-def run_basevar_chr(fq, chromosome): 
-    finish_flag = os.path.join(f"{basevar_outdir(fq)}_final", f"basevar_{chromosome}.finish")
+def reset_region_outputs(fq, chromosome, key):
+    # --smart-rerun reuses any region output on disk, so drop regions left by a different key
+    marker = os.path.join(basevar_outdir(fq), f"{chromosome}.key")
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if f.read().strip() == key:
+                return
+
+    for path in glob.glob(os.path.join(basevar_outdir(fq), f"{chromosome}_*")):
+        os.remove(path)
+    with open(marker, "w") as f:
+        f.write(key)
+
+
+def basevar_key(fq, chromosome):
+    return step_key("basevar", inputs=[REF, *list_entries(bamlist_dir(fq))], tools=["basevar", "bcftools", "tabix"],
+        params={"chromosome": chromosome, "delta": DELTA, "region_size": region_size(chromosome), "maf": MIN_AF})
+
 
-    # Step 0: Verify the flag
-    if os.path.exists(finish_flag):
+def prepare_basevar_chr(fq, chromosome):
+    merged_vcf = basevar_vcf(fq, chromosome)
+    key = basevar_key(fq, chromosome)
+
+    # Reuse a cached result for identical inputs; a miss removes any stale merged VCF
+    if restore_outputs(key, [merged_vcf, f"{merged_vcf}.tbi"]):
         print(f"Basevar result for {chromosome} {samid(fq)} already exist. Skip basevar for {chromosome}...")
         return
+    reset_region_outputs(fq, chromosome, key)
+    print(f"Run basevar for {fq} {chromosome} with {len(split_regions(chromosome))} regions of {region_size(chromosome)}bp")
 
-    print(f"Run basevar for {fq} {chromosome}")
 
-    # Step 1: Run BaseVar for the chromosome
-    run_basevar_step(fq, chromosome)
+def merge_basevar_chr(fq, chromosome):
+    merged_vcf = basevar_vcf(fq, chromosome)
+    if os.path.exists(merged_vcf):
+        return
 
-    # Step 2: Merge VCF files for the chromosome
-    merge_vcf_files(fq, chromosome)
+    outdir = basevar_outdir(fq)
+    region_vcfs = [f"{outdir}/{chr_id}_{start}_{end}.vcf.gz" for chr_id, start, end in split_regions(chromosome)]
+    merge_vcf_files(fq, chromosome, region_vcfs)
 
-    # Create finish flag
-    with open(finish_flag, "w") as flag:
-        flag.write(f"Completed BaseVar for {fq} {chromosome}.")
+    # Cache the merged VCF
+    store_outputs(basevar_key(fq, chromosome), [merged_vcf, f"{merged_vcf}.tbi"])
     print(f"Completed BaseVar for {fq} chromosome {chromosome}")
 
 
-def run_basevar(fq):
+def basevar_tasks(fq, deps=()):
     os.makedirs(f"{basevar_outdir(fq)}_final",exist_ok=True)
     os.makedirs(f"{basevar_outdir(fq)}",exist_ok=True)
 
-    with ThreadPoolExecutor(max_workers=PARAMETERS['threads']) as executor:
-        executor.map(lambda chr: run_basevar_chr(fq, chr), PARAMETERS["chrs"])
+    # One task per (chromosome, region) shard, so the scheduler spreads the shards of every
+    # chromosome over the whole thread budget
+    tasks = []
+    for chromosome in PARAMETERS["chrs"]:
+        name = f"{samid(fq)}.basevar.{chromosome}"
+        tasks.append(Task(f"{name}.prepare", prepare_basevar_chr, (fq, chromosome), deps=deps,
+            inputs=[bamlist_dir(fq), REF]))
+
+        shards = []
+        for chr_id, start, end in split_regions(chromosome):
+            shards.append(f"{name}.{start}_{end}")
+            tasks.append(Task(shards[-1], run_basevar_shard, (fq, chr_id, start, end), deps=[f"{name}.prepare"],
+                tool="basevar"))
+
+        tasks.append(Task(name, merge_basevar_chr, (fq, chromosome), deps=shards,
+            outputs=[basevar_vcf(fq, chromosome)], tool="bcftools"))
+    return tasks
+
+
+def run_basevar(fq):
+    run_tasks(basevar_tasks(fq))
 
     #shutil.rmtree(basevar_outdir(fq))
     print(f"Temporary directory {basevar_outdir(fq)} deleted.")
 
     print(f"Completed BaseVar pipeline for {fq}.")
-
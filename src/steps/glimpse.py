@@ -5,8 +5,10 @@ from helper.path_define import bamlist_dir, glimpse_outdir, dbsnp_dir, glimpse_a
 from helper.path_define import filtered_vcf_path, filtered_tsv_path, chunks_path, norm_vcf_path, glimpse_vcf
 from helper.logger import setup_logger
 from helper.converter import convert_haploid_to_diploid, convert_diploid_to_haploid
-from concurrent.futures import ThreadPoolExecutor
 from helper.file_utils import create_vcf_list, merge_vcf_list
+from helper.scheduler import Task, run_tasks, tool_cost, THREADS, MEMORY
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from helper.cache import step_key, list_entries, restore_outputs, store_outputs
 
 
 logger = setup_logger(os.path.join(PATHS["logs"], "glimpse_pipeline.log"))
@@ -19,6 +21,38 @@ GLIMPSE_PHASE = TOOLS["GLIMPSE_phase"]
 GLIMPSE_LIGATE = TOOLS["GLIMPSE_ligate"]
 REF = PATHS["ref"]
 MAP_PATH = PATHS["map_path"]
+GLIMPSE_THREADS, GLIMPSE_MEMORY = tool_cost("glimpse")
+RETRIES = PARAMETERS["glimpse"].get("retries", 2)
+COMPRESS_WORKERS = 2
+
+
+def phase_workers():
+    # Chunks a chromosome task phases side by side: as many GLIMPSE_phase processes as fit in the
+    # thread and memory budget, after COMPRESS_WORKERS threads are set aside for compression
+    workers = (THREADS - COMPRESS_WORKERS) // GLIMPSE_THREADS
+    if GLIMPSE_MEMORY:
+        workers = min(workers, MEMORY // GLIMPSE_MEMORY)
+    return max(1, workers)
+
+
+GL_THREADS, GL_MEMORY = tool_cost("bcftools")
+
+
+def gl_workers():
+    # Chunks a chromosome task computes GLs for side by side: as many bcftools mpileup | call
+    # pipelines as fit in the thread and memory budget
+    workers = THREADS // GL_THREADS
+    if GL_MEMORY:
+        workers = min(workers, MEMORY // GL_MEMORY)
+    return max(1, workers)
+
+
+PHASE_WORKERS = phase_workers()
+GL_WORKERS = gl_workers()
+
+# The GL shards and the phasing workers run one after the other, so the task books the larger of the two
+TASK_THREADS = max(PHASE_WORKERS * GLIMPSE_THREADS + COMPRESS_WORKERS, GL_WORKERS * GL_THREADS)
+TASK_MEMORY = max(PHASE_WORKERS * GLIMPSE_MEMORY, GL_WORKERS * GL_MEMORY)
 
 def create_samples_file_arg(fq):
     samples_file = os.path.join(os.path.join(glimpse_outdir(fq), "imputed_file"), "samples.txt")
@@ -35,57 +69,56 @@ def create_samples_file_arg(fq):
 
 
 
-def compute_gls(fq, chromosome):
+def read_chunks(chromosome):
+    chunks = []
+    with open(chunks_path(chromosome), "r") as chunk_file:
+        for line in chunk_file:
+            fields = line.strip().split()
+            if fields:
+                chunks.append((f"{int(fields[0]):02d}", fields[2], fields[3]))
+    return chunks
+
+
+def compute_gl_region(fq, chromosome, chunk_id, region):
     glpath = os.path.join(glimpse_outdir(fq), "GL_file")
-    bamlist = bamlist_dir(fq)
-    with open(bamlist, "r") as bam_file:
-        bam_lines = bam_file.readlines()
-
-    for line in bam_lines:
-        line = line.strip()
-        name = os.path.basename(line).split(".")[0]
-        output_vcf = os.path.join(glpath, f"{name}.{chromosome}.vcf.gz")
-    
-        try:
-            print(f"Computing GL for sample {name}, chromosome {chromosome}")
-            
-            mpileup_process = subprocess.Popen([BCFTOOLS, "mpileup",
-                "-f", REF, "-I", "-E", "-a", "FORMAT/DP",
-                "-T", filtered_vcf_path(chromosome), "-r", chromosome, line, "-Ou"
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            call_process = subprocess.run([BCFTOOLS, "call", "-Aim", "-C", "alleles",
-                "-T", filtered_tsv_path(chromosome), "-Oz", "-o", output_vcf
-            ], stdin=mpileup_process.stdout, capture_output=True, text=True, check=True)
-            
-            mpileup_process.stdout.close()
-            
-            # Check if mpileup had any errors
-            _, mpileup_stderr = mpileup_process.communicate()
-            if mpileup_process.returncode != 0:
-                print(f"Error in mpileup for sample {name}, chromosome {chromosome}:")
-                print(mpileup_stderr.decode())
-                
-        except subprocess.CalledProcessError as e:
-            print(f"Error in bcftools call for sample {name}, chromosome {chromosome}:")
-            print(f"Command: {e.cmd}")
-            print(f"Return code: {e.returncode}")
-            print(f"Output: {e.stdout}")
-            print(f"Error: {e.stderr}")
-        except Exception as e:
-            print(f"Unexpected error processing sample {name}, chromosome {chromosome}:")
-            print(str(e))
-
-        subprocess.run([TABIX, "-f", output_vcf], check=True)
-
-
-def merge_gls(fq, chromosome):
-    gl_list_path = create_vcf_list(os.path.join(glimpse_outdir(fq), "GL_file"), f"{chromosome}") 
+    output_bcf = os.path.join(glpath, f"{chromosome}.{chunk_id}.gl.bcf")
+    log_file = os.path.join(glpath, f"{chromosome}.{chunk_id}.log")
+
+    print(f"Computing GL for all samples, chromosome {chromosome}, region {region}")
+
+    with open(log_file, "w") as log:
+        mpileup_process = subprocess.Popen([BCFTOOLS, "mpileup",
+            "-f", REF, "-I", "-E", "-a", "FORMAT/DP",
+            "-T", filtered_vcf_path(chromosome), "-r", region, "-b", bamlist_dir(fq), "-Ou"
+        ], stdout=subprocess.PIPE, stderr=log)
+
+        call_process = subprocess.run([BCFTOOLS, "call", "-Aim", "-C", "alleles",
+            "-T", filtered_tsv_path(chromosome), "-Ob", "-o", output_bcf
+        ], stdin=mpileup_process.stdout, stderr=log)
+
+        mpileup_process.stdout.close()
+        mpileup_process.wait()
+
+    if mpileup_process.returncode != 0 or call_process.returncode != 0:
+        raise RuntimeError(f"GL computation failed for {chromosome} region {region}, see {log_file}")
+    return output_bcf
+
+
+def compute_gls(fq, chromosome):
+    # One multi-sample mpileup pass over bam.list per GLIMPSE chunk output region, GL_WORKERS at a time
+    regions = [(chunk_id, output_region) for chunk_id, _, output_region in read_chunks(chromosome)]
+    with ThreadPoolExecutor(max_workers=GL_WORKERS) as pool:
+        futures = [pool.submit(compute_gl_region, fq, chromosome, chunk_id, region) for chunk_id, region in regions]
+        return [future.result() for future in futures]
+
+
+def merge_gls(fq, chromosome, gl_shards):
     merged_vcf = os.path.join(os.path.join(glimpse_outdir(fq), "GL_file_merged"), f"{chromosome}.vcf.gz")
 
+    # Shards already hold every sample and follow the chunk order, so a concat replaces the per-sample merge
     print(f"Merging GL files for chromosome {chromosome}")
-    subprocess.run([BCFTOOLS, "merge", 
-        "-m", "none", "-r", chromosome, "-Oz", "-o", merged_vcf, "-l", gl_list_path
+    subprocess.run([BCFTOOLS, "concat",
+        "--threads", f"{min(TASK_THREADS, THREADS)}", "-Oz", "-o", merged_vcf, *gl_shards
     ], capture_output=True, text=True, check=True)
     
     subprocess.run([TABIX, "-f", merged_vcf], check=True)
@@ -93,47 +126,72 @@ def merge_gls(fq, chromosome):
     print(f"Merged GL file created at {merged_vcf}")
 
 
-def phase_genome(fq, chromosome):
+def phase_chunk(fq, chromosome, chunk_id, input_region, output_region):
     imputed_path = os.path.join(glimpse_outdir(fq), "imputed_file")
-    map_file = os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz")
-    reference_vcf = norm_vcf_path(chromosome)
-    chunk_file = chunks_path(chromosome)
     merged_vcf = os.path.join(os.path.join(glimpse_outdir(fq), "GL_file_merged"), f"{chromosome}.vcf.gz")
-    samples_file = os.path.join(imputed_path, "samples.txt")
+    output_vcf = os.path.join(imputed_path, f"{chromosome}.{chunk_id}.imputed.vcf")
+
+    print(f"Phasing chromosome {chromosome}, chunk {chunk_id}")
+
+    command = [GLIMPSE_PHASE,
+        "--input-gl", merged_vcf,
+        "--reference", norm_vcf_path(chromosome),
+        "--map", os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz"),
+        "--input-region", input_region,
+        "--output-region", output_region,
+        "--output", output_vcf,
+        "--threads", f"{GLIMPSE_THREADS}"
+    ]
+    if chromosome == "chrX":
+        command.extend(["--samples-file", os.path.join(imputed_path, "samples.txt")])
 
-    with open(chunk_file, "r") as chunks:
-        for line in chunks:
-            fields = line.strip().split()
-            chunk_id = f"{int(fields[0]):02d}"
-            input_region = fields[2]
-            output_region = fields[3]
-            output_vcf = os.path.join(imputed_path, f"{chromosome}.{chunk_id}.imputed.vcf")
-
-            print(f"Phasing chromosome {chromosome}, chunk {chunk_id}")
-
-            command = [GLIMPSE_PHASE,
-                "--input-gl", merged_vcf,
-                "--reference", reference_vcf,
-                "--map", map_file,
-                "--input-region", input_region,
-                "--output-region", output_region,
-                "--output", output_vcf
-            ]
-            if chromosome == "chrX":
-                command.extend(["--samples-file", samples_file])
-
-            process = subprocess.run(command, capture_output=True, text=True)
-            if process.returncode != 0:
-                logger.warning(f"Error phasing chromosome {chromosome}, chunk {chunk_id}: {process.stderr}")
-                continue
-
-            if os.path.exists(f"{output_vcf}.gz"):
-                os.remove(f"{output_vcf}.gz")
-
-            subprocess.run([BGZIP, output_vcf], check=True)
-            if chromosome == "chrX" and PARAMETERS['gender'] == 1:
-                convert_haploid_to_diploid(f"{output_vcf}.gz")
-            subprocess.run([TABIX, "-f", f"{output_vcf}.gz"], check=True)
+    process = subprocess.run(command, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Error phasing chromosome {chromosome}, chunk {chunk_id}: {process.stderr}")
+    return output_vcf
+
+
+def compress_chunk(chromosome, output_vcf):
+    if os.path.exists(f"{output_vcf}.gz"):
+        os.remove(f"{output_vcf}.gz")
+
+    subprocess.run([BGZIP, output_vcf], check=True)
+    if chromosome == "chrX" and PARAMETERS['gender'] == 1:
+        convert_haploid_to_diploid(f"{output_vcf}.gz")
+    subprocess.run([TABIX, "-f", f"{output_vcf}.gz"], check=True)
+
+
+def phase_genome(fq, chromosome):
+    attempts = {}
+    failed = []
+    compressed = []
+
+    # PHASE_WORKERS chunks phase at once, as booked on the task; each finished chunk is
+    # compressed and indexed on the compression pool while the next chunks are still phasing
+    with ThreadPoolExecutor(max_workers=PHASE_WORKERS) as phase_pool, \
+            ThreadPoolExecutor(max_workers=COMPRESS_WORKERS) as compress_pool:
+        futures = {phase_pool.submit(phase_chunk, fq, chromosome, *chunk): chunk for chunk in read_chunks(chromosome)}
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk = futures.pop(future)
+                try:
+                    output_vcf = future.result()
+                except Exception as e:
+                    attempts[chunk] = attempts.get(chunk, 0) + 1
+                    logger.warning(f"Chunk {chunk[0]} of {chromosome} failed (attempt {attempts[chunk]}): {e}")
+                    if attempts[chunk] > RETRIES:
+                        failed.append(chunk[0])
+                    else:
+                        futures[phase_pool.submit(phase_chunk, fq, chromosome, *chunk)] = chunk
+                    continue
+                compressed.append(compress_pool.submit(compress_chunk, chromosome, output_vcf))
+
+        for future in compressed:
+            future.result()
+
+    if failed:
+        raise RuntimeError(f"Phasing failed for {fq} {chromosome} chunks {sorted(failed)}")
 
 
 def extract_chunk_id(fq, chromosome):
@@ -205,20 +263,27 @@ def annotate(fq, chromosome):
 
 
 def run_glimpse_chr(fq, chromosome):
-    finish_flag = os.path.join(f"{glimpse_outdir(fq)}", "imputed", f"glimpse_{chromosome}.finish")
-
-    # Step 0: Verify the flag
-    if os.path.exists(finish_flag):
+    imputed_vcf = glimpse_vcf(fq, chromosome)
+    annotated_vcf = glimpse_annot(fq, chromosome)
+    outputs = [imputed_vcf, f"{imputed_vcf}.tbi", annotated_vcf, f"{annotated_vcf}.tbi"]
+    inputs = [REF, filtered_vcf_path(chromosome), filtered_tsv_path(chromosome), norm_vcf_path(chromosome),
+        chunks_path(chromosome), os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz"), dbsnp_dir(),
+        os.path.join(glimpse_outdir(fq), "imputed_file", "samples.txt"), *list_entries(bamlist_dir(fq))]
+    key = step_key("glimpse", inputs=inputs, tools=["bcftools", "bgzip", "tabix", "GLIMPSE_phase", "GLIMPSE_ligate"],
+        params={"chromosome": chromosome, "maf": PARAMETERS["maf"], "gender": PARAMETERS.get("gender")})
+
+    # Step 0: Reuse a cached result for identical inputs
+    if restore_outputs(key, outputs):
         print(f"Glimpse result for {chromosome} {fq} already exist. Skip glimpse for {chromosome}...")
         return
 
     print(f"Starting glimpse for chromosome {chromosome}...")
 
     # Step 1: Compute GLs
-    compute_gls(fq, chromosome)
+    gl_shards = compute_gls(fq, chromosome)
 
     # Step 2: Merge GLs
-    merge_gls(fq, chromosome)
+    merge_gls(fq, chromosome, gl_shards)
 
     # Step 3: Phase genome
     phase_genome(fq, chromosome)
@@ -230,18 +295,29 @@ def run_glimpse_chr(fq, chromosome):
     # Step 5: Annotate
     annotate(fq, chromosome)
 
-    # Create finish flag
-    with open(finish_flag, "w") as flag:
-        flag.write(f"Completed Glimpse for {fq} {chromosome}.")
+    # Cache the imputed and annotated VCFs
+    store_outputs(key, outputs)
     print(f"Completed Glimpse for {fq} chromosome {chromosome}")
 
 
-def run_glimpse(fq):    
+def glimpse_tasks(fq, deps=()):
     os.makedirs(os.path.join(glimpse_outdir(fq), "GL_file"), exist_ok=True)
     os.makedirs(os.path.join(glimpse_outdir(fq), "GL_file_merged"), exist_ok=True)
     os.makedirs(os.path.join(glimpse_outdir(fq), "imputed_file"), exist_ok=True)
     os.makedirs(os.path.join(glimpse_outdir(fq), "imputed"), exist_ok=True)
     os.makedirs(os.path.join(glimpse_outdir(fq), "annotated"), exist_ok=True)
+
+    samples_task = f"{samid(fq)}.glimpse.samples"
+    tasks = [Task(samples_task, create_samples_file_arg, (fq,), deps=deps)]
+    for chromosome in PARAMETERS["chrs"]:
+        tasks.append(Task(f"{samid(fq)}.glimpse.{chromosome}", run_glimpse_chr, (fq, chromosome), deps=[*deps, samples_task],
+            inputs=[bamlist_dir(fq), norm_vcf_path(chromosome), chunks_path(chromosome)],
+            outputs=[glimpse_vcf(fq, chromosome), glimpse_annot(fq, chromosome)],
+            threads=TASK_THREADS, memory=TASK_MEMORY))
+    return tasks
+
+
+def run_glimpse(fq):    
     finish_flag = os.path.join(glimpse_outdir(fq), "glimpse.finish")
 
     # Verify the flag
@@ -249,9 +325,7 @@ def run_glimpse(fq):
         print(f"Glimpse result for {fq} already exist. Skip glimpse step...")
         #return
     
-    create_samples_file_arg(fq)
-    with ThreadPoolExecutor(max_workers=PARAMETERS['threads']) as executor:
-        executor.map(lambda chr: run_glimpse_chr(fq, chr), PARAMETERS["chrs"])
+    run_tasks(glimpse_tasks(fq))
     
     #shutil.rmtree(os.path.join(glimpse_outdir(fq), "GL_file"))
     #shutil.rmtree(os.path.join(glimpse_outdir(fq), "GL_file_merged"))